@@ -0,0 +1,183 @@
+import argparse
+import json
+import multiprocessing
+import platform
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# 各阶段的性能测试：在CPU后端上扫描grid_num、surface_grid_num和particle_num，
+# 分别测每个阶段和完整一帧的耗时，结果写成JSON。每组配置在单独的进程中运行，
+# 保证ti.init互不影响，峰值内存也是该配置自己的
+
+
+def peak_memory_mb():
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux下单位为KB，macOS下为字节
+    if platform.system() == 'Darwin':
+        return usage / 1024 ** 2
+    return usage / 1024
+
+
+def timed(ti, function, *args):
+    ti.sync()
+    start = time.perf_counter()
+    function(*args)
+    ti.sync()
+    return time.perf_counter() - start
+
+
+def summary(samples, work):
+    mean = sum(samples) / len(samples)
+    return {
+        'mean': mean,
+        'min': min(samples),
+        'max': max(samples),
+        'throughput': work / mean if mean > 0 else None,
+    }
+
+
+def run_config(config):
+    import taichi as ti
+    # 只在指定了线程数时传入，ti.init不接受None
+    init_kwargs = {'cpu_max_num_threads': config['threads']} if config['threads'] else {}
+    ti.init(arch=ti.cpu, random_seed=0, **init_kwargs)
+    from mpm_solver import MPMSolver
+
+    solver = MPMSolver(config['particle_num'], grid_num=config['grid_num'],
+                       surface_grid_num=config['surface_grid_num'], fused_substep=False)
+    solver.init_surface()
+    solver.add_cube(ti.Vector([0.35, 0.5, 0.35]), 0.23, config['particle_num'], solver.material_water)
+    surface = solver.fluid_surface_solver
+
+    # 预热：完整跑一帧，完成所有kernel的编译
+    for _ in range(config['warmup']):
+        solver.run(0, 0)
+
+    particle_num = solver.create_particle_num[None]
+    node_num = config['surface_grid_num'] ** 3
+    grid_node_num = config['grid_num'] ** 3
+    # 阶段名、调用和吞吐量的计量单位（每秒处理的粒子、网格节点或表面粒子数）
+    stages = [
+        ('create_level_set', lambda: surface.create_level_set(solver.particles.position, solver.particles.material,
+                                                              solver.create_particle_num), particle_num),
+        ('calculate_gradient', surface.calculate_gradient, node_num),
+        ('calculate_laplacian', surface.calculate_laplacian, node_num),
+        ('implicit_to_explicit', lambda: (surface.init_surface_particles(), surface.implicit_to_explicit()),
+         node_num),
+        ('discrete_triangles', surface.discrete_triangles, None),
+        ('add_tension', solver.add_tension, None),
+        ('P2G', lambda: (solver.reset_node(), solver.P2G()), particle_num),
+        ('grid_operator', solver.grid_operator, grid_node_num),
+        ('G2P', solver.G2P, particle_num),
+    ]
+    samples = {name: [] for name, _, _ in stages}
+    work = {name: unit for name, _, unit in stages}
+    solver.substep_dt[None] = solver.dt
+    for _ in range(config['repeats']):
+        for name, function, unit in stages:
+            samples[name].append(timed(ti, function))
+            # 三角形和表面粒子数只有执行后才知道
+            if name == 'discrete_triangles':
+                work[name] = work['add_tension'] = surface.surface_particle_num[None]
+    result = {name: summary(samples[name], work[name] or 0) for name, _, _ in stages}
+    result['triangles'] = surface.create_triangle_num[None]
+    result['surface_particles'] = surface.surface_particle_num[None]
+
+    frame_samples = [timed(ti, solver.run, frame, 0) for frame in range(config['frames'])]
+    result['frame'] = summary(frame_samples, particle_num * solver.steps)
+    result['peak_memory_mb'] = peak_memory_mb()
+    return {'config': config, 'particle_num': particle_num, 'stages': result}
+
+
+# 用随机粒子分别构建窄带splat的level set和暴力遍历的参考结果，两者在窄带内（参考值小于far_distance）应当一致
+def check_level_set(config):
+    import numpy as np
+    import taichi as ti
+    init_kwargs = {'cpu_max_num_threads': config['threads']} if config['threads'] else {}
+    ti.init(arch=ti.cpu, random_seed=0, **init_kwargs)
+    from fluid_surface import FluidSurface
+
+    grid_num, particle_num = config['surface_grid_num'], config['particle_num']
+    surface = FluidSurface(grid_num=grid_num, particle_type=0, radius=0.8 / grid_num)
+    surface.init_field()
+    surface.numpy_to_field()
+    position = ti.Vector.field(3, ti.f32, shape=particle_num)
+    material = ti.field(ti.i32, shape=particle_num)
+    create_particle_num = ti.field(ti.i32, shape=())
+    rng = np.random.default_rng(0)
+    position.from_numpy((rng.random((particle_num, 3)) * 0.6 + 0.2).astype(np.float32))
+    # 混入其他材料的粒子，同时检查材料过滤
+    material.from_numpy(rng.integers(0, 2, particle_num).astype(np.int32))
+    create_particle_num[None] = particle_num
+
+    surface.create_level_set(position, material, create_particle_num)
+    splat = surface.sign_distance_field.to_numpy()
+    surface.create_level_set_brute_force(position, material, create_particle_num)
+    reference = surface.sign_distance_field.to_numpy()
+    band = reference < surface.far_distance
+    error = float(np.abs(splat - reference)[band].max()) if band.any() else 0.0
+    if error > 1e-5:
+        raise AssertionError('create_level_set differs from brute force by {} inside the band'.format(error))
+    return {'surface_grid_num': grid_num, 'particle_num': particle_num, 'band_nodes': int(band.sum()),
+            'max_error': error}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MPM solver benchmark on the CPU backend')
+    parser.add_argument('--grid-num', type=int, nargs='+', default=[64, 128])
+    parser.add_argument('--surface-grid-num', type=int, nargs='+', default=[64, 80])
+    parser.add_argument('--particle-num', type=int, nargs='+', default=[10000, 30000])
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--frames', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=0, help='CPU线程数，0表示使用默认值')
+    parser.add_argument('--check-particle-num', type=int, default=2000,
+                        help='level set与暴力解对比使用的粒子数，0表示不检查')
+    parser.add_argument('--output', default='benchmark.json')
+    args = parser.parse_args()
+
+    configs = [{
+        'grid_num': grid_num,
+        'surface_grid_num': surface_grid_num,
+        'particle_num': particle_num,
+        'repeats': args.repeats,
+        'warmup': args.warmup,
+        'frames': args.frames,
+        'threads': args.threads,
+    } for grid_num in args.grid_num for surface_grid_num in args.surface_grid_num
+        for particle_num in args.particle_num]
+
+    context = multiprocessing.get_context('spawn')
+    checks = []
+    if args.check_particle_num > 0:
+        for surface_grid_num in args.surface_grid_num:
+            config = {'surface_grid_num': surface_grid_num, 'particle_num': args.check_particle_num,
+                      'threads': args.threads}
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                check = executor.submit(check_level_set, config).result()
+            print('level set check', check)
+            checks.append(check)
+
+    results = []
+    for config in configs:
+        print('benchmark', config)
+        # 每组配置使用新的进程，结束后释放全部内存
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            result = executor.submit(run_config, config).result()
+        print('  frame {:.3f}s'.format(result['stages']['frame']['mean']))
+        results.append(result)
+
+    with open(args.output, 'w') as f:
+        json.dump({'platform': platform.platform(), 'python': platform.python_version(),
+                   'level_set_check': checks, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,20 +7,89 @@ class FluidSurface:
     def __init__(self,
                  grid_num,
                  particle_type,
-                 radius):
+                 radius,
+                 band_width=3,
+                 sparse=False,
+                 block_size=8,
+                 redistance=False,
+                 sample_spacing=None,
+                 max_surface_particle_num=80000,
+                 lazy_stencil=False,
+                 incremental=False,
+                 incremental_tolerance=0.1,
+                 max_particle_num=0,
+                 dx=None):
         self.grid_num = grid_num
         self.particle_type = particle_type
         self.radius = radius
-        self.dx = 1 / (grid_num - 1)
+        # 默认网格覆盖[0, 1]，也可以指定dx与MPM背景网格对齐（节点I位于I * dx）
+        self.dx = dx if dx is not None else 1 / (grid_num - 1)
         self.inv_dx = 1 / self.dx
-        self.sign_distance_field = ti.field(ti.f32, shape=(self.grid_num,) * 3)
-        self.gradient = ti.Vector.field(3, ti.f32, shape=(self.grid_num,) * 3)
-        self.divergence = ti.field(ti.f32, shape=(self.grid_num,) * 3)
-        self.laplacian = ti.field(ti.f32, shape=(self.grid_num,) * 3)
-        # 绘制用
-        # self.color_list = ti.Vector.field(3, ti.f32, shape=self.grid_num ** 3)
-        # self.node_position = ti.Vector.field(3, ti.f32, shape=self.grid_num ** 3)
-        self.node_position_field = ti.Vector.field(3, ti.f32, shape=(self.grid_num,) * 3)
+        # 由网格质量构建level set时的统计量
+        self.mass_sum = ti.field(ti.f32, shape=())
+        self.mass_node_num = ti.field(ti.i32, shape=())
+        # 窄带宽度（网格数），距离所有粒子球面超过窄带的节点统一截断为far_distance
+        self.band_width = band_width
+        self.far_distance = self.band_width * self.dx
+        # 重新距离化：以液面附近节点为种子，用jump flood把真实距离传播到整个网格
+        self.redistance = redistance
+        self.no_seed = 1e6
+        self.jump_flood_steps = []
+        step = 1 << (max(self.grid_num - 1, 1).bit_length() - 1)
+        while step >= 1:
+            self.jump_flood_steps.append(step)
+            step //= 2
+        # 最后再做一次步长为1的传播（JFA+1），修正少量错误的最近点
+        self.jump_flood_steps.append(1)
+        # 稀疏窄带模式：只存储粒子附近的block，其余节点视为截断的far值
+        self.sparse = sparse
+        self.block_size = block_size
+        self.block_num = -(-self.grid_num // self.block_size)
+        # 增量模式：记录上次写入level set时的粒子位置，只有粒子移动超过incremental_tolerance个网格时，
+        # 才重新计算其新旧位置影响范围内的block，其余block保留上次的结果
+        self.incremental = incremental
+        if self.incremental and (sparse or redistance):
+            raise ValueError('incremental level set requires dense storage without redistancing')
+        self.incremental_tolerance = incremental_tolerance * self.dx
+        self.level_set_valid = False
+        if self.incremental:
+            self.reference_position = ti.Vector.field(3, ti.f32, shape=max_particle_num)
+            # block_dirty为需要重算SDF的block，block_update再向外扩展一个block，用于梯度和拉普拉斯
+            self.block_dirty = ti.field(ti.i32, shape=(self.block_num,) * 3)
+            self.block_update = ti.field(ti.i32, shape=(self.block_num,) * 3)
+            self.dirty_block_num = ti.field(ti.i32, shape=())
+        # 惰性模式：不存储整个网格上的梯度和拉普拉斯，插值时在采样点周围的节点上直接做差分
+        self.lazy_stencil = lazy_stencil
+        if self.sparse:
+            self.sign_distance_field = ti.field(ti.f32)
+            self.sdf_block = ti.root.pointer(ti.ijk, self.block_num)
+            self.sdf_leaf = self.sdf_block.bitmasked(ti.ijk, self.block_size)
+            self.sdf_leaf.place(self.sign_distance_field)
+            if not self.lazy_stencil:
+                self.gradient = ti.Vector.field(3, ti.f32)
+                self.laplacian = ti.field(ti.f32)
+                self.sdf_leaf.place(self.gradient, self.laplacian)
+            self.edge_vertex_id = ti.field(ti.i32)
+            self.sdf_leaf.dense(ti.l, 3).place(self.edge_vertex_id)
+            if self.redistance:
+                self.closest_point = ti.Vector.field(3, ti.f32)
+                self.closest_point_buffer = ti.Vector.field(3, ti.f32)
+                self.sdf_leaf.place(self.closest_point, self.closest_point_buffer)
+            # block状态：0为包含液面或在液体外，1为完全在液体内，2为已裁剪的液体内部block
+            self.block_state = ti.field(ti.i32, shape=(self.block_num,) * 3)
+        else:
+            self.sign_distance_field = ti.field(ti.f32, shape=(self.grid_num,) * 3)
+            if not self.lazy_stencil:
+                self.gradient = ti.Vector.field(3, ti.f32, shape=(self.grid_num,) * 3)
+                self.laplacian = ti.field(ti.f32, shape=(self.grid_num,) * 3)
+            # 绘制用
+            # self.color_list = ti.Vector.field(3, ti.f32, shape=self.grid_num ** 3)
+            # self.node_position = ti.Vector.field(3, ti.f32, shape=self.grid_num ** 3)
+            # 每个节点沿x、y、z正方向的边上的Marching Cube顶点编号
+            self.edge_vertex_id = ti.field(ti.i32, shape=(self.grid_num,) * 3 + (3,))
+            if self.redistance:
+                self.closest_point = ti.Vector.field(3, ti.f32, shape=(self.grid_num,) * 3)
+                self.closest_point_buffer = ti.Vector.field(3, ti.f32, shape=(self.grid_num,) * 3)
         self._edge_table = np.array([
             0x0, 0x109, 0x203, 0x30a, 0x406, 0x50f, 0x605, 0x70c,
             0x80c, 0x905, 0xa0f, 0xb06, 0xc0a, 0xd03, 0xe09, 0xf00,
@@ -310,25 +379,56 @@ class FluidSurface:
                                          [0, 9, 1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1],
                                          [0, 3, 8, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1],
                                          [-1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1]], np.int32)
+        # 单元的12条边对应的起点节点偏移和方向(0:x, 1:y, 2:z)，与triangle_table的边编号一致
+        self._edge_node_table = np.array([[0, 0, 0, 0], [1, 0, 0, 2], [0, 0, 1, 0], [0, 0, 0, 2],
+                                          [0, 1, 0, 0], [1, 1, 0, 2], [0, 1, 1, 0], [0, 1, 0, 2],
+                                          [0, 0, 0, 1], [1, 0, 0, 1], [1, 0, 1, 1], [0, 0, 1, 1]], np.int32)
         self.edge_table = ti.field(ti.i32)
         self.triangle_table = ti.field(ti.i32)
+        self.edge_node_table = ti.field(ti.i32)
 
-        self.explicit_triangles = ti.Vector.field(3, ti.f32, shape=self.grid_num ** 3)
+        # 带索引的Marching Cube网格：共享的边顶点只计算一次
+        self.max_triangle_num = min(self.grid_num ** 3 // 3, 32 * self.grid_num ** 2)
+        self.max_vertex_num = self.max_triangle_num
+        self.mesh_vertices = ti.Vector.field(3, ti.f32, shape=self.max_vertex_num)
+        self.triangle_indices = ti.Vector.field(3, ti.i32, shape=self.max_triangle_num)
+        self.create_vertex_num = ti.field(ti.i32, shape=())
         self.create_triangle_num = ti.field(ti.i32, shape=())
-        self.discrete_num = 3
+        self.mesh_overflow = ti.field(ti.i32, shape=())
+        # 含有三角形的单元的压缩列表，offset在前缀和之前保存的是单元内的三角形数/顶点数
+        self.active_cell_num = ti.field(ti.i32, shape=())
+        self.active_cells = ti.Vector.field(3, ti.i32, shape=self.max_triangle_num)
+        self.active_cell_case = ti.field(ti.i32, shape=self.max_triangle_num)
+        self.active_cell_triangle_offset = ti.field(ti.i32, shape=self.max_triangle_num)
+        self.active_cell_vertex_offset = ti.field(ti.i32, shape=self.max_triangle_num)
+        # 两级并行前缀和：每个block内串行扫描，只有block总和的扫描是串行的
+        self.scan_block_size = 256
+        self.scan_block_sum = ti.field(ti.i32, shape=-(-self.max_triangle_num // self.scan_block_size))
+        # 三角形离散为表面粒子的目标间距，每个表面粒子代表约sample_spacing²的面积
+        self.sample_spacing = sample_spacing if sample_spacing is not None else self.dx * 0.5
+        self.triangle_area = ti.field(ti.f32, shape=self.max_triangle_num)
+        self.triangle_sample_num = ti.field(ti.i32, shape=self.max_triangle_num)
+        self.triangle_sample_offset = ti.field(ti.i32, shape=self.max_triangle_num)
+        # 表面粒子超出容量时采样间距的放大倍数（1表示未放大），以及仍然放不下而丢弃的粒子数
+        self.sample_spacing_scale = ti.field(ti.f32, shape=())
+        self.surface_particle_overflow = ti.field(ti.i32, shape=())
 
+        self.max_surface_particle_num = max_surface_particle_num
         self.surface_particle_num = ti.field(ti.i32, shape=())
         self.surface_particles = ti.Struct.field({
             "position": ti.types.vector(3, ti.f32),
-        }, shape=80000)
+            "area": ti.f32,
+        }, shape=self.max_surface_particle_num)
 
     def init_field(self):
         ti.root.dense(ti.i, 256).place(self.edge_table)
         ti.root.dense(ti.ij, self._triangle_table.shape).place(self.triangle_table)
+        ti.root.dense(ti.ij, self._edge_node_table.shape).place(self.edge_node_table)
 
     def numpy_to_field(self):
         self.edge_table.from_numpy(self._edge_table)
         self.triangle_table.from_numpy(self._triangle_table)
+        self.edge_node_table.from_numpy(self._edge_node_table)
 
     # 每帧开始，将构建的表面粒子删除
     @ti.kernel
@@ -338,28 +438,320 @@ class FluidSurface:
         self.surface_particle_num[None] = 0
 
     @ti.func
-    def create_particle(self, pos):
-        n = ti.atomic_add(self.surface_particle_num[None], 1)
-        self.surface_particles[n].position = pos
+    def create_particle(self, n, pos, area):
+        if n < self.max_surface_particle_num:
+            self.surface_particles[n].position = pos
+            self.surface_particles[n].area = area
 
+    # 按面积决定三角形的细分次数m，三角形被均分为m²个小三角形
     @ti.func
-    def discrete_triangle(self, A, B, C):
+    def triangle_subdivision(self, n, scale):
+        return ti.max(1, ti.ceil(ti.sqrt(self.triangle_area[n]) / (self.sample_spacing * scale)).cast(int))
+
+    # 在m²个小三角形的重心处采样，采样点不落在共享的边和顶点上，相邻三角形之间不会重复
+    @ti.func
+    def discrete_triangle(self, A, B, C, m, offset, area):
         ab = B - A
         ac = C - A
-        for i, j in ti.ndrange(self.discrete_num, self.discrete_num):
-            if i + j < self.discrete_num + 1:
-                pos = A + ((i / self.discrete_num) * ab + (j / self.discrete_num) * ac)
-                self.create_particle(pos)
+        n = offset
+        for i in range(m):
+            for j in range(m - i):
+                self.create_particle(n, A + ((i + 1.0 / 3.0) * ab + (j + 1.0 / 3.0) * ac) / m, area)
+                n += 1
+                if i + j < m - 1:
+                    self.create_particle(n, A + ((i + 2.0 / 3.0) * ab + (j + 2.0 / 3.0) * ac) / m, area)
+                    n += 1
 
-    # 初始化level set
+    # 初始化level set，粒子数以0维field传入，在设备端读取，避免每次构建都同步
     # union每个粒子的球形level set，求出每个网格顶点的SDF
+    # 每个粒子只把球形SDF写到自身周围半径+窄带范围内的节点上（atomic_min），
+    # 复杂度与粒子数成正比，窄带内的结果与遍历所有粒子的暴力解法一致
+    # 返回level set是否发生变化，增量模式下没有block需要更新时返回False
+    def create_level_set(self, position, material, create_particle_num):
+        if self.incremental:
+            if self.level_set_valid:
+                self.mark_dirty_blocks(position, material, create_particle_num)
+                if self.dirty_block_num[None] == 0:
+                    return False
+                self.update_dirty_blocks(position, material, create_particle_num)
+                return True
+            self.mark_all_blocks()
+            self.store_reference_position(position, create_particle_num)
+            self.level_set_valid = True
+        if self.sparse:
+            self.sdf_block.deactivate_all()
+        self.reset_level_set(position, material, create_particle_num)
+        self.splat_level_set(position, material, create_particle_num)
+        if self.sparse:
+            self.classify_level_set_blocks()
+            self.prune_level_set()
+        if self.redistance:
+            self.redistance_level_set()
+        return True
+
+    # 由P2G得到的网格质量构建level set，网格需与本类的网格重合。质量除以非零节点的平均质量得到液体占比，
+    # 3x3x3盒式滤波平滑后以0.5为液面，先近似为距离，再由jump flood重新距离化
+    def create_level_set_from_mass(self, mass):
+        self.mass_statistics(mass)
+        self.mass_indicator(mass)
+        if self.redistance:
+            self.redistance_level_set()
+        return True
+
+    @ti.kernel
+    def mass_statistics(self, mass: ti.template()):
+        self.mass_sum[None] = 0.0
+        self.mass_node_num[None] = 0
+        for I in ti.grouped(ti.ndrange(self.grid_num, self.grid_num, self.grid_num)):
+            if mass[I] > 0:
+                self.mass_sum[None] += mass[I]
+                self.mass_node_num[None] += 1
+
+    @ti.kernel
+    def mass_indicator(self, mass: ti.template()):
+        mean_mass = self.mass_sum[None] / ti.max(self.mass_node_num[None], 1)
+        inv_mean_mass = 1.0 / ti.max(mean_mass, 1e-12)
+        for I in ti.grouped(self.sign_distance_field):
+            fraction = 0.0
+            for offset in ti.static(ti.grouped(ti.ndrange((-1, 2), (-1, 2), (-1, 2)))):
+                neighbour = ti.min(ti.max(I + offset, 0), self.grid_num - 1)
+                fraction += ti.min(mass[neighbour] * inv_mean_mass, 1.0)
+            fraction /= 27
+            # 占比在液面附近约两个网格内从1降到0
+            phi = (0.5 - fraction) * 2 * self.dx
+            self.sign_distance_field[I] = ti.min(ti.max(phi, -self.far_distance), self.far_distance)
+
+    # 粒子数或粒子编号改变时调用，下一次create_level_set完整重建
+    def invalidate_level_set(self):
+        self.level_set_valid = False
+
+    # 完整重建：所有block都需要更新，并记录粒子位置
+    @ti.kernel
+    def mark_all_blocks(self):
+        for B in ti.grouped(self.block_dirty):
+            self.block_dirty[B] = 1
+            self.block_update[B] = 1
+        self.dirty_block_num[None] = self.block_num ** 3
+
+    @ti.kernel
+    def store_reference_position(self, position: ti.template(), create_particle_num: ti.template()):
+        for p in range(create_particle_num[None]):
+            self.reference_position[p] = position[p]
+
+    @ti.func
+    def mark_box_dirty(self, pos):
+        lower, upper = self.particle_box(pos)
+        lower_block, upper_block = lower // self.block_size, upper // self.block_size
+        for bi in range(lower_block[0], upper_block[0] + 1):
+            for bj in range(lower_block[1], upper_block[1] + 1):
+                for bk in range(lower_block[2], upper_block[2] + 1):
+                    if ti.atomic_or(self.block_dirty[bi, bj, bk], 1) == 0:
+                        ti.atomic_add(self.dirty_block_num[None], 1)
+
+    # 移动超过容差的粒子，其旧位置和新位置的影响范围都标记为脏
+    @ti.kernel
+    def mark_dirty_blocks(self, position: ti.template(), material: ti.template(), create_particle_num: ti.template()):
+        for B in ti.grouped(self.block_dirty):
+            self.block_dirty[B] = 0
+            self.block_update[B] = 0
+        self.dirty_block_num[None] = 0
+        for p in range(create_particle_num[None]):
+            if material[p] == self.particle_type:
+                if (position[p] - self.reference_position[p]).norm() > self.incremental_tolerance:
+                    self.mark_box_dirty(self.reference_position[p])
+                    self.mark_box_dirty(position[p])
+                    self.reference_position[p] = position[p]
+
+    # 粒子的影响范围是否与脏block相交
+    @ti.func
+    def box_dirty(self, pos):
+        lower, upper = self.particle_box(pos)
+        lower_block, upper_block = lower // self.block_size, upper // self.block_size
+        dirty = 0
+        for bi in range(lower_block[0], upper_block[0] + 1):
+            for bj in range(lower_block[1], upper_block[1] + 1):
+                for bk in range(lower_block[2], upper_block[2] + 1):
+                    dirty |= self.block_dirty[bi, bj, bk]
+        return dirty
+
+    # 只重置并重新写入脏block内的节点，再把脏block向外扩展一个block作为模板计算的更新范围
+    @ti.kernel
+    def update_dirty_blocks(self, position: ti.template(), material: ti.template(),
+                            create_particle_num: ti.template()):
+        for I in ti.grouped(self.sign_distance_field):
+            if self.block_dirty[I // self.block_size]:
+                self.sign_distance_field[I] = self.far_distance
+        for p in range(create_particle_num[None]):
+            if material[p] == self.particle_type and self.box_dirty(position[p]):
+                lower, upper = self.particle_box(position[p])
+                for i in range(lower[0], upper[0] + 1):
+                    for j in range(lower[1], upper[1] + 1):
+                        for k in range(lower[2], upper[2] + 1):
+                            if self.block_dirty[i // self.block_size, j // self.block_size, k // self.block_size]:
+                                node_pos = ti.Vector([i, j, k]) * self.dx
+                                distance = (position[p] - node_pos).norm() - self.radius
+                                if distance < self.far_distance:
+                                    ti.atomic_min(self.sign_distance_field[i, j, k], distance)
+        for B in ti.grouped(self.block_dirty):
+            if self.block_dirty[B]:
+                for offset in ti.static(ti.grouped(ti.ndrange((-1, 2), (-1, 2), (-1, 2)))):
+                    neighbour = ti.min(ti.max(B + offset, 0), self.block_num - 1)
+                    self.block_update[neighbour] = 1
+
+    # 增量模式下只计算更新范围内的节点
+    @ti.func
+    def node_needs_update(self, I):
+        result = 1
+        if ti.static(self.incremental):
+            result = self.block_update[I // self.block_size]
+        return result
+
+    @ti.func
+    def particle_box(self, pos):
+        reach = self.radius + self.far_distance
+        lower = ti.max(ti.ceil((pos - reach) * self.inv_dx).cast(int), 0)
+        upper = ti.min(ti.floor((pos + reach) * self.inv_dx).cast(int), self.grid_num - 1)
+        return lower, upper
+
+    # 稠密模式下将所有节点置为far值；稀疏模式下只激活粒子周围窄带内的节点
+    @ti.kernel
+    def reset_level_set(self, position: ti.template(), material: ti.template(), create_particle_num: ti.template()):
+        if ti.static(self.sparse):
+            for p in range(create_particle_num[None]):
+                if material[p] == self.particle_type:
+                    lower, upper = self.particle_box(position[p])
+                    for i in range(lower[0], upper[0] + 1):
+                        for j in range(lower[1], upper[1] + 1):
+                            for k in range(lower[2], upper[2] + 1):
+                                self.sign_distance_field[i, j, k] = self.far_distance
+        else:
+            for I in ti.grouped(self.sign_distance_field):
+                self.sign_distance_field[I] = self.far_distance
+
+    @ti.kernel
+    def splat_level_set(self, position: ti.template(), material: ti.template(), create_particle_num: ti.template()):
+        for p in range(create_particle_num[None]):
+            if material[p] == self.particle_type:
+                lower, upper = self.particle_box(position[p])
+                for i in range(lower[0], upper[0] + 1):
+                    for j in range(lower[1], upper[1] + 1):
+                        for k in range(lower[2], upper[2] + 1):
+                            node_pos = ti.Vector([i, j, k]) * self.dx
+                            distance = (position[p] - node_pos).norm() - self.radius
+                            if distance < self.far_distance:
+                                ti.atomic_min(self.sign_distance_field[i, j, k], distance)
+
+    # 标记完全位于液体内部的block
     @ti.kernel
-    def create_level_set(self, position: ti.template(), material: ti.template(), create_particle_num: int):
+    def classify_level_set_blocks(self):
+        for B in ti.grouped(self.block_state):
+            self.block_state[B] = 0
+        for B in ti.grouped(self.sdf_block):
+            self.block_state[B] = 1
+        for I in ti.grouped(self.sign_distance_field):
+            if self.sign_distance_field[I] >= 0:
+                self.block_state[I // self.block_size] = 0
+
+    # 周围26个block都在液体内部的block远离液面，释放其存储，读取时按-far_distance处理
+    @ti.kernel
+    def prune_level_set(self):
+        for B in ti.grouped(self.sdf_block):
+            interior = self.block_state[B]
+            for offset in ti.static(ti.grouped(ti.ndrange((-1, 2), (-1, 2), (-1, 2)))):
+                neighbour = ti.min(ti.max(B + offset, 0), self.block_num - 1)
+                if self.block_state[neighbour] == 0:
+                    interior = 0
+            if interior:
+                self.block_state[B] = 2
+        for B in ti.grouped(self.block_state):
+            if self.block_state[B] == 2:
+                ti.deactivate(self.sdf_block, B)
+
+    # 读取节点上的SDF，稀疏模式下未存储的节点返回截断值
+    @ti.func
+    def signed_distance(self, i, j, k):
+        result = 0.0
+        if ti.static(self.sparse):
+            result = self.far_distance
+            if ti.is_active(self.sdf_leaf, [i, j, k]):
+                result = self.sign_distance_field[i, j, k]
+            elif self.block_state[i // self.block_size, j // self.block_size, k // self.block_size] == 2:
+                result = -self.far_distance
+        else:
+            result = self.sign_distance_field[i, j, k]
+        return result
+
+    # 节点是否存储了SDF（稠密模式下恒为真）
+    @ti.func
+    def node_stored(self, i, j, k):
+        result = 1
+        if ti.static(self.sparse):
+            result = ti.is_active(self.sdf_leaf, [i, j, k])
+        return result
+
+    # 重新距离化，使SDF在整个网格上满足|∇φ|=1
+    def redistance_level_set(self):
+        self.seed_redistance()
+        src, dst = self.closest_point, self.closest_point_buffer
+        for step in self.jump_flood_steps:
+            self.jump_flood(step, src, dst)
+            src, dst = dst, src
+        self.finish_redistance(src)
+
+    # 与相邻节点SDF异号的节点是种子，沿梯度方向投影得到液面上的最近点
+    @ti.kernel
+    def seed_redistance(self):
+        for I in ti.grouped(self.sign_distance_field):
+            i, j, k = I
+            phi = self.signed_distance(i, j, k)
+            near_surface = 0
+            for d in ti.static(range(3)):
+                for s in ti.static((-1, 1)):
+                    neighbour = I + s * ti.Vector.unit(3, d, ti.i32)
+                    if 0 <= neighbour[d] < self.grid_num:
+                        if phi * self.signed_distance(neighbour[0], neighbour[1], neighbour[2]) <= 0:
+                            near_surface = 1
+            closest = ti.Vector([self.no_seed, self.no_seed, self.no_seed])
+            if near_surface:
+                closest = I * self.dx - phi * self.sdf_gradient(i, j, k).normalized(1e-8)
+            self.closest_point[I] = closest
+
+    # jump flood：每个节点在步长为step的26个邻居记录的最近点中选取距离最近的
+    @ti.kernel
+    def jump_flood(self, step: int, src: ti.template(), dst: ti.template()):
+        for I in ti.grouped(self.sign_distance_field):
+            node_pos = I * self.dx
+            best = src[I]
+            best_dis = (best - node_pos).norm()
+            for offset in ti.static(ti.grouped(ti.ndrange((-1, 2), (-1, 2), (-1, 2)))):
+                neighbour = I + offset * step
+                if neighbour.min() >= 0 and neighbour.max() < self.grid_num:
+                    if self.node_stored(neighbour[0], neighbour[1], neighbour[2]):
+                        candidate = src[neighbour]
+                        dis = (candidate - node_pos).norm()
+                        if dis < best_dis:
+                            best = candidate
+                            best_dis = dis
+            dst[I] = best
+
+    # 用到最近点的距离替换SDF的绝对值，符号保持不变
+    @ti.kernel
+    def finish_redistance(self, src: ti.template()):
+        for I in ti.grouped(self.sign_distance_field):
+            dis = (src[I] - I * self.dx).norm()
+            if dis < self.no_seed * 0.5:
+                if self.sign_distance_field[I] < 0:
+                    dis = -dis
+                self.sign_distance_field[I] = dis
+
+    # 暴力求解的level set，每个网格节点遍历所有粒子，仅作为create_level_set的参考结果
+    @ti.kernel
+    def create_level_set_brute_force(self, position: ti.template(), material: ti.template(),
+                                     create_particle_num: ti.template()):
         for I in ti.grouped(self.sign_distance_field):
             node_pos = I * self.dx
-            self.node_position_field[I] = node_pos
             min_dis = 10.0
-            for p in range(create_particle_num):
+            for p in range(create_particle_num[None]):
                 if material[p] == self.particle_type:
                     distance = (position[p] - node_pos).norm() - self.radius
                     if distance < min_dis:
@@ -380,175 +772,315 @@ class FluidSurface:
             result = position1
         return result
 
+    # 单元八个顶点的内外状态编码
     @ti.func
-    def edge_position(self, edge, i, j, k):
-        result = ti.Vector([0.0, 0.0, 0.0])
-        if edge == 0:
-            result = self.get_point_position(self.node_position_field[i, j, k],
-                                             self.node_position_field[i + 1, j, k],
-                                             self.sign_distance_field[i, j, k],
-                                             self.sign_distance_field[i + 1, j, k])
-        if edge == 1:
-            result = self.get_point_position(self.node_position_field[i + 1, j, k],
-                                             self.node_position_field[i + 1, j, k + 1],
-                                             self.sign_distance_field[i + 1, j, k],
-                                             self.sign_distance_field[i + 1, j, k + 1])
-        if edge == 2:
-            result = self.get_point_position(self.node_position_field[i + 1, j, k + 1],
-                                             self.node_position_field[i, j, k + 1],
-                                             self.sign_distance_field[i + 1, j, k + 1],
-                                             self.sign_distance_field[i, j, k + 1])
-        if edge == 3:
-            result = self.get_point_position(self.node_position_field[i, j, k + 1],
-                                             self.node_position_field[i, j, k],
-                                             self.sign_distance_field[i, j, k + 1],
-                                             self.sign_distance_field[i, j, k])
-        if edge == 4:
-            result = self.get_point_position(self.node_position_field[i, j + 1, k],
-                                             self.node_position_field[i + 1, j + 1, k],
-                                             self.sign_distance_field[i, j + 1, k],
-                                             self.sign_distance_field[i + 1, j + 1, k])
-        if edge == 5:
-            result = self.get_point_position(self.node_position_field[i + 1, j + 1, k],
-                                             self.node_position_field[i + 1, j + 1, k + 1],
-                                             self.sign_distance_field[i + 1, j + 1, k],
-                                             self.sign_distance_field[i + 1, j + 1, k + 1])
-        if edge == 6:
-            result = self.get_point_position(self.node_position_field[i + 1, j + 1, k + 1],
-                                             self.node_position_field[i, j + 1, k + 1],
-                                             self.sign_distance_field[i + 1, j + 1, k + 1],
-                                             self.sign_distance_field[i, j + 1, k + 1])
-        if edge == 7:
-            result = self.get_point_position(self.node_position_field[i, j + 1, k + 1],
-                                             self.node_position_field[i, j + 1, k],
-                                             self.sign_distance_field[i, j + 1, k + 1],
-                                             self.sign_distance_field[i, j + 1, k])
-        if edge == 8:
-            result = self.get_point_position(self.node_position_field[i, j, k],
-                                             self.node_position_field[i, j + 1, k],
-                                             self.sign_distance_field[i, j, k],
-                                             self.sign_distance_field[i, j + 1, k])
-        if edge == 9:
-            result = self.get_point_position(self.node_position_field[i + 1, j, k],
-                                             self.node_position_field[i + 1, j + 1, k],
-                                             self.sign_distance_field[i + 1, j, k],
-                                             self.sign_distance_field[i + 1, j + 1, k])
-        if edge == 10:
-            result = self.get_point_position(self.node_position_field[i + 1, j, k + 1],
-                                             self.node_position_field[i + 1, j + 1, k + 1],
-                                             self.sign_distance_field[i + 1, j, k + 1],
-                                             self.sign_distance_field[i + 1, j + 1, k + 1])
-        if edge == 11:
-            result = self.get_point_position(self.node_position_field[i, j, k + 1],
-                                             self.node_position_field[i, j + 1, k + 1],
-                                             self.sign_distance_field[i, j, k + 1],
-                                             self.sign_distance_field[i, j + 1, k + 1])
-        return result
+    def cube_index(self, i, j, k):
+        id = 0
+        if self.signed_distance(i, j, k) < 0:
+            id |= 1
+        if self.signed_distance(i + 1, j, k) < 0:
+            id |= 2
+        if self.signed_distance(i + 1, j, k + 1) < 0:
+            id |= 4
+        if self.signed_distance(i, j, k + 1) < 0:
+            id |= 8
+        if self.signed_distance(i, j + 1, k) < 0:
+            id |= 16
+        if self.signed_distance(i + 1, j + 1, k) < 0:
+            id |= 32
+        if self.signed_distance(i + 1, j + 1, k + 1) < 0:
+            id |= 64
+        if self.signed_distance(i, j + 1, k + 1) < 0:
+            id |= 128
+        return id
+
+    # 边的起点节点
+    @ti.func
+    def edge_node(self, edge, i, j, k):
+        return ti.Vector([i + self.edge_node_table[edge, 0],
+                          j + self.edge_node_table[edge, 1],
+                          k + self.edge_node_table[edge, 2]])
+
+    # 每条边只归一个单元所有：起点节点所在的单元，位于网格上边界的边归相邻的内部单元
+    @ti.func
+    def own_edge(self, edge, i, j, k):
+        owner = ti.min(self.edge_node(edge, i, j, k), self.grid_num - 2)
+        return owner[0] == i and owner[1] == j and owner[2] == k
+
+    @ti.func
+    def edge_vertex(self, edge, i, j, k):
+        node = self.edge_node(edge, i, j, k)
+        return self.edge_vertex_id[node[0], node[1], node[2], self.edge_node_table[edge, 3]]
 
     # 将隐式Level Set转化为显示Marching Cube
-    @ti.kernel
+    # 单元分类压缩 -> 前缀和 -> 计算共享顶点 -> 写入三角形索引，不再对每个三角形角点重复插值
     def implicit_to_explicit(self):
-        self.create_triangle_num[None] = 0
-        for i, j, k in ti.ndrange(self.grid_num - 1, self.grid_num - 1, self.grid_num - 1):
-            id = 0
-            if self.sign_distance_field[i, j, k] < 0:
-                id |= 1
-            if self.sign_distance_field[i + 1, j, k] < 0:
-                id |= 2
-            if self.sign_distance_field[i + 1, j, k + 1] < 0:
-                id |= 4
-            if self.sign_distance_field[i, j, k + 1] < 0:
-                id |= 8
-            if self.sign_distance_field[i, j + 1, k] < 0:
-                id |= 16
-            if self.sign_distance_field[i + 1, j + 1, k] < 0:
-                id |= 32
-            if self.sign_distance_field[i + 1, j + 1, k + 1] < 0:
-                id |= 64
-            if self.sign_distance_field[i, j + 1, k + 1] < 0:
-                id |= 128
-            for t in range(4):
+        self.classify_cells()
+        self.scan_cells()
+        self.emit_vertices()
+        self.emit_triangles()
+
+    # 找出含有三角形的单元，并统计每个单元的三角形数和拥有的顶点数
+    @ti.kernel
+    def classify_cells(self):
+        self.active_cell_num[None] = 0
+        # 稀疏模式下只遍历已存储的节点
+        for i, j, k in self.sign_distance_field:
+            if i >= self.grid_num - 1 or j >= self.grid_num - 1 or k >= self.grid_num - 1:
+                continue
+            id = self.cube_index(i, j, k)
+            if id == 0 or id == 255:
+                continue
+            triangle_num = 0
+            for t in range(5):
                 if self.triangle_table[id, t * 3] != -1:
-                    n = ti.atomic_add(self.create_triangle_num[None], 1)
-                    self.explicit_triangles[n * 3] = self.edge_position(self.triangle_table[id, t * 3], i, j, k)
-                    self.explicit_triangles[n * 3 + 1] = self.edge_position(self.triangle_table[id, t * 3 + 1], i, j, k)
-                    self.explicit_triangles[n * 3 + 2] = self.edge_position(self.triangle_table[id, t * 3 + 2], i, j, k)
+                    triangle_num += 1
+            vertex_num = 0
+            for edge in range(12):
+                if self.edge_table[id] & (1 << edge) != 0 and self.own_edge(edge, i, j, k):
+                    vertex_num += 1
+            c = ti.atomic_add(self.active_cell_num[None], 1)
+            if c < self.max_triangle_num:
+                self.active_cells[c] = ti.Vector([i, j, k])
+                self.active_cell_case[c] = id
+                self.active_cell_triangle_offset[c] = triangle_num
+                self.active_cell_vertex_offset[c] = vertex_num
 
-    # 将Marching Cube得到的三角形离散为表面粒子
+    # 对values的前n项做原地的exclusive前缀和，返回总和。block之间并行，
+    # 串行部分只有n / scan_block_size个block总和
+    @ti.func
+    def exclusive_scan(self, values: ti.template(), n):
+        block_num = (n + self.scan_block_size - 1) // self.scan_block_size
+        for b in range(block_num):
+            total = 0
+            for c in range(b * self.scan_block_size, ti.min((b + 1) * self.scan_block_size, n)):
+                count = values[c]
+                values[c] = total
+                total += count
+            self.scan_block_sum[b] = total
+        offset = 0
+        ti.loop_config(serialize=True)
+        for b in range(block_num):
+            count = self.scan_block_sum[b]
+            self.scan_block_sum[b] = offset
+            offset += count
+        for c in range(n):
+            values[c] += self.scan_block_sum[c // self.scan_block_size]
+        return offset
+
+    # 对单元的三角形数和顶点数做前缀和，得到各单元的写入位置
+    @ti.kernel
+    def scan_cells(self):
+        cell_num = ti.min(self.active_cell_num[None], self.max_triangle_num)
+        triangle_offset = self.exclusive_scan(self.active_cell_triangle_offset, cell_num)
+        vertex_offset = self.exclusive_scan(self.active_cell_vertex_offset, cell_num)
+        self.mesh_overflow[None] = 0
+        if self.active_cell_num[None] > self.max_triangle_num or triangle_offset > self.max_triangle_num \
+                or vertex_offset > self.max_vertex_num:
+            self.mesh_overflow[None] = 1
+        self.create_triangle_num[None] = ti.min(triangle_offset, self.max_triangle_num)
+        self.create_vertex_num[None] = ti.min(vertex_offset, self.max_vertex_num)
+
+    # 每个单元计算自己拥有的边上的顶点
     @ti.kernel
+    def emit_vertices(self):
+        for c in range(ti.min(self.active_cell_num[None], self.max_triangle_num)):
+            i, j, k = self.active_cells[c]
+            id = self.active_cell_case[c]
+            n = self.active_cell_vertex_offset[c]
+            for edge in range(12):
+                if self.edge_table[id] & (1 << edge) != 0 and self.own_edge(edge, i, j, k):
+                    node = self.edge_node(edge, i, j, k)
+                    axis = self.edge_node_table[edge, 3]
+                    end = node + ti.Vector([int(axis == 0), int(axis == 1), int(axis == 2)])
+                    self.edge_vertex_id[node[0], node[1], node[2], axis] = n
+                    if n < self.max_vertex_num:
+                        self.mesh_vertices[n] = self.get_point_position(
+                            node * self.dx, end * self.dx,
+                            self.signed_distance(node[0], node[1], node[2]),
+                            self.signed_distance(end[0], end[1], end[2]))
+                    n += 1
+
+    # 根据共享顶点编号写入三角形索引，超出顶点容量的三角形退化为一个点
+    @ti.kernel
+    def emit_triangles(self):
+        for c in range(ti.min(self.active_cell_num[None], self.max_triangle_num)):
+            i, j, k = self.active_cells[c]
+            id = self.active_cell_case[c]
+            n = self.active_cell_triangle_offset[c]
+            for t in range(5):
+                if self.triangle_table[id, t * 3] != -1:
+                    if n < self.max_triangle_num:
+                        triangle = ti.Vector([0, 0, 0])
+                        for v in ti.static(range(3)):
+                            triangle[v] = self.edge_vertex(self.triangle_table[id, t * 3 + v], i, j, k)
+                        if triangle.max() >= self.max_vertex_num:
+                            triangle = ti.Vector([0, 0, 0])
+                        self.triangle_indices[n] = triangle
+                    n += 1
+
+    # 将带索引的Marching Cube网格拷贝到导出缓冲区，法线由SDF梯度插值得到
+    @ti.kernel
+    def copy_mesh(self, vertices: ti.types.ndarray(), normals: ti.types.ndarray(), indices: ti.types.ndarray(),
+                  with_normals: int):
+        for n in range(self.create_vertex_num[None]):
+            position = self.mesh_vertices[n]
+            normal = ti.Vector([0.0, 0.0, 0.0])
+            if with_normals:
+                normal = self.linear_interpolation_normal(position).normalized(1e-8)
+            for d in ti.static(range(3)):
+                vertices[n, d] = position[d]
+                normals[n, d] = normal[d]
+        for n in range(self.create_triangle_num[None]):
+            for d in ti.static(range(3)):
+                indices[n, d] = self.triangle_indices[n][d]
+
+    # 将Marching Cube得到的三角形离散为表面粒子
+    # 先统计每个三角形的采样数并做前缀和，再写入，粒子数超过容量时放大采样间距而不是越界写入
     def discrete_triangles(self):
-        self.surface_particle_num[None] = 0
+        self.measure_triangles()
+        self.scan_triangle_samples()
+        self.emit_triangle_samples()
+
+    @ti.kernel
+    def measure_triangles(self):
         for n in range(self.create_triangle_num[None]):
-            self.discrete_triangle(
-                self.explicit_triangles[n * 3],
-                self.explicit_triangles[n * 3 + 1],
-                self.explicit_triangles[n * 3 + 2])
+            triangle = self.triangle_indices[n]
+            A = self.mesh_vertices[triangle[0]]
+            self.triangle_area[n] = 0.5 * (self.mesh_vertices[triangle[1]] - A).cross(
+                self.mesh_vertices[triangle[2]] - A).norm()
+
+    @ti.kernel
+    def scan_triangle_samples(self):
+        triangle_num = self.create_triangle_num[None]
+        scale = 1.0
+        total = 0
+        for n in range(triangle_num):
+            total += self.triangle_subdivision(n, scale) ** 2
+        # 每个三角形至少一个采样点，放大间距也放不下时只能丢弃超出的部分。
+        # 只有表面粒子超出容量时才会进入这里，循环在while内按串行执行
+        while total > self.max_surface_particle_num and total > triangle_num:
+            scale *= ti.sqrt(total / self.max_surface_particle_num) * 1.05
+            total = 0
+            for n in range(triangle_num):
+                total += self.triangle_subdivision(n, scale) ** 2
+        for n in range(triangle_num):
+            m = self.triangle_subdivision(n, scale)
+            self.triangle_sample_num[n] = m
+            self.triangle_sample_offset[n] = m * m
+        offset = self.exclusive_scan(self.triangle_sample_offset, triangle_num)
+        self.sample_spacing_scale[None] = scale
+        self.surface_particle_overflow[None] = ti.max(offset - self.max_surface_particle_num, 0)
+        self.surface_particle_num[None] = ti.min(offset, self.max_surface_particle_num)
 
-    # 计算梯度算子（法线）
     @ti.kernel
+    def emit_triangle_samples(self):
+        for n in range(self.create_triangle_num[None]):
+            triangle = self.triangle_indices[n]
+            m = self.triangle_sample_num[n]
+            self.discrete_triangle(
+                self.mesh_vertices[triangle[0]],
+                self.mesh_vertices[triangle[1]],
+                self.mesh_vertices[triangle[2]],
+                m, self.triangle_sample_offset[n], self.triangle_area[n] / (m * m))
+
+    # 节点处SDF的中心差分梯度（未归一化）
+    @ti.func
+    def sdf_gradient(self, i, j, k):
+        u, v, w = .0, .0, .0
+        # 判断边界条件
+        if i == 0:
+            u = (self.signed_distance(i + 1, j, k) - self.signed_distance(i, j, k)) * 0.5 * self.inv_dx
+        elif i == self.grid_num - 1:
+            u = (self.signed_distance(i, j, k) - self.signed_distance(i - 1, j, k)) * 0.5 * self.inv_dx
+        else:
+            u = (self.signed_distance(i + 1, j, k) - self.signed_distance(i - 1, j, k)) * 0.5 * self.inv_dx
+
+        if j == 0:
+            v = (self.signed_distance(i, j + 1, k) - self.signed_distance(i, j, k)) * 0.5 * self.inv_dx
+        elif j == self.grid_num - 1:
+            v = (self.signed_distance(i, j, k) - self.signed_distance(i, j - 1, k)) * 0.5 * self.inv_dx
+        else:
+            v = (self.signed_distance(i, j + 1, k) - self.signed_distance(i, j - 1, k)) * 0.5 * self.inv_dx
+
+        if k == 0:
+            w = (self.signed_distance(i, j, k + 1) - self.signed_distance(i, j, k)) * 0.5 * self.inv_dx
+        elif k == self.grid_num - 1:
+            w = (self.signed_distance(i, j, k) - self.signed_distance(i, j, k - 1)) * 0.5 * self.inv_dx
+        else:
+            w = (self.signed_distance(i, j, k + 1) - self.signed_distance(i, j, k - 1)) * 0.5 * self.inv_dx
+        return ti.Vector([u, v, w])
+
+    # 节点处SDF的二阶差分拉普拉斯
+    @ti.func
+    def sdf_laplacian(self, i, j, k):
+        u, v, w = .0, .0, .0
+        if i == 0:
+            u = (self.signed_distance(i + 1, j, k) - self.signed_distance(i, j, k)) * self.inv_dx * self.inv_dx
+        elif i == self.grid_num - 1:
+            u = (-self.signed_distance(i, j, k) + self.signed_distance(i - 1, j, k)) * self.inv_dx * self.inv_dx
+        else:
+            u = (self.signed_distance(i + 1, j, k) - 2 * self.signed_distance(i, j, k) +
+                 self.signed_distance(i - 1, j, k)) * self.inv_dx * self.inv_dx
+
+        if j == 0:
+            v = (self.signed_distance(i, j + 1, k) - self.signed_distance(i, j, k)) * self.inv_dx * self.inv_dx
+        elif j == self.grid_num - 1:
+            v = (-self.signed_distance(i, j, k) + self.signed_distance(i, j - 1, k)) * self.inv_dx * self.inv_dx
+        else:
+            v = (self.signed_distance(i, j + 1, k) - 2 * self.signed_distance(i, j, k) +
+                 self.signed_distance(i, j - 1, k)) * self.inv_dx * self.inv_dx
+
+        if k == 0:
+            w = (self.signed_distance(i, j, k + 1) - self.signed_distance(i, j, k)) * self.inv_dx * self.inv_dx
+        elif k == self.grid_num - 1:
+            w = (-self.signed_distance(i, j, k) + self.signed_distance(i, j, k - 1)) * self.inv_dx * self.inv_dx
+        else:
+            w = (self.signed_distance(i, j, k + 1) - 2 * self.signed_distance(i, j, k) +
+                 self.signed_distance(i, j, k - 1)) * self.inv_dx * self.inv_dx
+        return u + v + w
+
+    # 节点处的单位法线和曲率，惰性模式下由SDF现场差分得到
+    @ti.func
+    def node_normal(self, i, j, k):
+        result = ti.Vector([0.0, 0.0, 0.0])
+        if ti.static(self.lazy_stencil):
+            result = self.sdf_gradient(i, j, k).normalized(1e-8)
+        else:
+            result = self.gradient[i, j, k]
+        return result
+
+    @ti.func
+    def node_curvature(self, i, j, k):
+        result = 0.0
+        if ti.static(self.lazy_stencil):
+            result = self.sdf_laplacian(i, j, k)
+        else:
+            result = self.laplacian[i, j, k]
+        return result
+
+    # 计算梯度算子（法线），惰性模式下不需要
     def calculate_gradient(self):
-        for I in ti.grouped(self.sign_distance_field):
-            i, j, k = I
-            u, v, w = .0, .0, .0
-            # 判断边界条件
-            if i == 0:
-                u = (self.sign_distance_field[i + 1, j, k] - self.sign_distance_field[i, j, k]) * 0.5 * self.inv_dx
-            elif i == self.grid_num - 1:
-                u = (self.sign_distance_field[i, j, k] - self.sign_distance_field[i - 1, j, k]) * 0.5 * self.inv_dx
-            else:
-                u = (self.sign_distance_field[i + 1, j, k] - self.sign_distance_field[i - 1, j, k]) * 0.5 * self.inv_dx
-
-            if j == 0:
-                v = (self.sign_distance_field[i, j + 1, k] - self.sign_distance_field[i, j, k]) * 0.5 * self.inv_dx
-            elif j == self.grid_num - 1:
-                v = (self.sign_distance_field[i, j, k] - self.sign_distance_field[i, j - 1, k]) * 0.5 * self.inv_dx
-            else:
-                v = (self.sign_distance_field[i, j + 1, k] - self.sign_distance_field[i, j - 1, k]) * 0.5 * self.inv_dx
-
-            if k == 0:
-                w = (self.sign_distance_field[i, j, k + 1] - self.sign_distance_field[i, j, k]) * 0.5 * self.inv_dx
-            elif k == self.grid_num - 1:
-                w = (self.sign_distance_field[i, j, k] - self.sign_distance_field[i, j, k - 1]) * 0.5 * self.inv_dx
-            else:
-                w = (self.sign_distance_field[i, j, k + 1] - self.sign_distance_field[i, j, k - 1]) * 0.5 * self.inv_dx
-            self.gradient[I] = ti.Vector([u, v, w]).normalized()
-
-    # 计算拉普拉斯算子（曲率）
+        if not self.lazy_stencil:
+            self.calculate_gradient_field()
+
     @ti.kernel
+    def calculate_gradient_field(self):
+        for I in ti.grouped(self.sign_distance_field):
+            # 窄带外SDF为常数，梯度为0，加eps避免归一化得到NaN
+            if self.node_needs_update(I):
+                self.gradient[I] = self.sdf_gradient(I[0], I[1], I[2]).normalized(1e-8)
+
+    # 计算拉普拉斯算子（曲率），惰性模式下不需要
     def calculate_laplacian(self):
+        if not self.lazy_stencil:
+            self.calculate_laplacian_field()
+
+    @ti.kernel
+    def calculate_laplacian_field(self):
         for I in ti.grouped(self.sign_distance_field):
-            i, j, k = I
-            u, v, w = .0, .0, .0
-            if i == 0:
-                u = (self.sign_distance_field[i + 1, j, k] - self.sign_distance_field[
-                    i, j, k]) * self.inv_dx * self.inv_dx
-            elif i == self.grid_num - 1:
-                u = (-self.sign_distance_field[i, j, k] + self.sign_distance_field[
-                    i - 1, j, k]) * self.inv_dx * self.inv_dx
-            else:
-                u = (self.sign_distance_field[i + 1, j, k] - 2 * self.sign_distance_field[i, j, k] +
-                     self.sign_distance_field[i - 1, j, k]) * self.inv_dx * self.inv_dx
-
-            if j == 0:
-                v = (self.sign_distance_field[i, j + 1, k] - self.sign_distance_field[
-                    i, j, k]) * self.inv_dx * self.inv_dx
-            elif j == self.grid_num - 1:
-                v = (-self.sign_distance_field[i, j, k] + self.sign_distance_field[
-                    i, j - 1, k]) * self.inv_dx * self.inv_dx
-            else:
-                v = (self.sign_distance_field[i, j + 1, k] - 2 * self.sign_distance_field[i, j, k] +
-                     self.sign_distance_field[i, j - 1, k]) * self.inv_dx * self.inv_dx
-
-            if k == 0:
-                w = (self.sign_distance_field[i, j, k + 1] - self.sign_distance_field[
-                    i, j, k]) * self.inv_dx * self.inv_dx
-            elif k == self.grid_num - 1:
-                w = (-self.sign_distance_field[i, j, k] + self.sign_distance_field[
-                    i, j, k - 1]) * self.inv_dx * self.inv_dx
-            else:
-                w = (self.sign_distance_field[i, j, k + 1] - 2 * self.sign_distance_field[i, j, k] +
-                     self.sign_distance_field[i, j, k - 1]) * self.inv_dx * self.inv_dx
-            self.laplacian[I] = u + v + w
+            if self.node_needs_update(I):
+                self.laplacian[I] = self.sdf_laplacian(I[0], I[1], I[2])
 
     # 三次线性插值函数
     @ti.func
@@ -561,7 +1093,7 @@ class FluidSurface:
         for i, j, k in ti.static(ti.ndrange(2, 2, 2)):
             weight = w[i][0] * w[j][1] * w[k][2] * self.inv_dx * self.inv_dx * self.inv_dx
             offset = [i, j, k]
-            result += self.sign_distance_field[base + offset] * weight
+            result += self.signed_distance(base[0] + i, base[1] + j, base[2] + k) * weight
         return result
 
     @ti.func
@@ -572,8 +1104,7 @@ class FluidSurface:
         result = ti.Vector([0.0, 0.0, 0.0])
         for i, j, k in ti.static(ti.ndrange(2, 2, 2)):
             weight = w[i][0] * w[j][1] * w[k][2] * self.inv_dx * self.inv_dx * self.inv_dx
-            offset = [i, j, k]
-            result += self.gradient[base + offset] * weight
+            result += self.node_normal(base[0] + i, base[1] + j, base[2] + k) * weight
         return result
 
     @ti.func
@@ -585,6 +1116,5 @@ class FluidSurface:
         result = 0.0
         for i, j, k in ti.static(ti.ndrange(2, 2, 2)):
             weight = w[i][0] * w[j][1] * w[k][2] * self.inv_dx * self.inv_dx * self.inv_dx
-            offset = [i, j, k]
-            result += self.laplacian[base + offset] * weight
+            result += self.node_curvature(base[0] + i, base[1] + j, base[2] + k) * weight
         return result
@@ -0,0 +1,138 @@
+import os
+import queue
+import threading
+
+import numpy as np
+
+
+# 异步写出：仿真线程只把数据拷贝到预先分配的缓冲区，写文件在后台线程完成，
+# 写第N帧的同时仿真可以继续计算
+class AsyncWriter:
+    formats = ()
+
+    def __init__(self, output_dir, buffers, file_format, prefix):
+        if file_format not in self.formats:
+            raise ValueError('unsupported export format: {}'.format(file_format))
+        self.output_dir = output_dir
+        self.file_format = file_format
+        self.prefix = prefix
+        os.makedirs(self.output_dir, exist_ok=True)
+        # 多缓冲，所有缓冲区都在写出时acquire会等待
+        self.buffers = buffers
+        self.free_buffers = queue.Queue()
+        for i in range(len(self.buffers)):
+            self.free_buffers.put(i)
+        self.jobs = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def acquire(self):
+        self.check_error()
+        return self.free_buffers.get()
+
+    def submit(self, frame, index, *counts):
+        self.jobs.put((frame, index, counts))
+
+    def frame_path(self, frame, extension):
+        return os.path.join(self.output_dir, '{}_{:06d}.{}'.format(self.prefix, frame, extension))
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            frame, index, counts = job
+            try:
+                self.write(frame, self.buffers[index], *counts)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.free_buffers.put(index)
+
+    def write(self, frame, buffer, *counts):
+        raise NotImplementedError
+
+    def check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    # 等待所有帧写完并结束后台线程
+    def close(self):
+        self.jobs.put(None)
+        self.thread.join()
+        self.check_error()
+
+
+# 导出每帧的粒子位置
+class FrameExporter(AsyncWriter):
+    formats = ('ply', 'raw')
+
+    def __init__(self, output_dir, max_particle_num, file_format='ply', prefix='water', buffer_num=2):
+        buffers = [np.zeros((max_particle_num, 3), dtype=np.float32) for _ in range(buffer_num)]
+        super().__init__(output_dir, buffers, file_format, prefix)
+
+    def write(self, frame, buffer, count):
+        positions = buffer[:count]
+        extension = 'ply' if self.file_format == 'ply' else 'bin'
+        with open(self.frame_path(frame, extension), 'wb') as f:
+            if self.file_format == 'ply':
+                f.write(('ply\n'
+                         'format binary_little_endian 1.0\n'
+                         'element vertex {}\n'
+                         'property float x\n'
+                         'property float y\n'
+                         'property float z\n'
+                         'end_header\n').format(len(positions)).encode('ascii'))
+            # raw格式为连续的小端float32 (N, 3)数组
+            f.write(positions.astype('<f4', copy=False).tobytes())
+
+
+# 导出每帧的液面网格（带索引的三角形网格，可选顶点法线）
+class MeshExporter(AsyncWriter):
+    formats = ('ply', 'obj')
+
+    def __init__(self, output_dir, max_vertex_num, max_triangle_num, file_format='ply', prefix='surface',
+                 normals=True, buffer_num=2):
+        self.normals = normals
+        buffers = [{
+            'vertices': np.zeros((max_vertex_num, 3), dtype=np.float32),
+            'normals': np.zeros((max_vertex_num, 3), dtype=np.float32),
+            'indices': np.zeros((max_triangle_num, 3), dtype=np.int32),
+        } for _ in range(buffer_num)]
+        super().__init__(output_dir, buffers, file_format, prefix)
+
+    def write(self, frame, buffer, vertex_num, triangle_num):
+        vertices = buffer['vertices'][:vertex_num]
+        normals = buffer['normals'][:vertex_num]
+        indices = buffer['indices'][:triangle_num]
+        if self.file_format == 'ply':
+            self.write_ply(self.frame_path(frame, 'ply'), vertices, normals, indices)
+        else:
+            self.write_obj(self.frame_path(frame, 'obj'), vertices, normals, indices)
+
+    def write_ply(self, path, vertices, normals, indices):
+        header = ['ply', 'format binary_little_endian 1.0', 'element vertex {}'.format(len(vertices)),
+                  'property float x', 'property float y', 'property float z']
+        if self.normals:
+            header += ['property float nx', 'property float ny', 'property float nz']
+            vertices = np.hstack([vertices, normals])
+        header += ['element face {}'.format(len(indices)), 'property list uchar int vertex_indices', 'end_header']
+        faces = np.empty(len(indices), dtype=[('n', 'u1'), ('i', '<i4', (3,))])
+        faces['n'] = 3
+        faces['i'] = indices
+        with open(path, 'wb') as f:
+            f.write(('\n'.join(header) + '\n').encode('ascii'))
+            f.write(vertices.astype('<f4', copy=False).tobytes())
+            f.write(faces.tobytes())
+
+    def write_obj(self, path, vertices, normals, indices):
+        with open(path, 'w') as f:
+            np.savetxt(f, vertices, fmt='v %.6f %.6f %.6f')
+            faces = indices + 1
+            if self.normals:
+                np.savetxt(f, normals, fmt='vn %.6f %.6f %.6f')
+                np.savetxt(f, np.repeat(faces, 2, axis=1), fmt='f %d//%d %d//%d %d//%d')
+            else:
+                np.savetxt(f, faces, fmt='f %d %d %d')
@@ -1,8 +1,9 @@
-import taichi as ti
-
-from mpm_solver import MPMSolver
-
-ti.init(arch=ti.gpu)
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 # 坐标系统：      +y
 #               |
@@ -16,24 +17,181 @@ ti.init(arch=ti.gpu)
 #           /
 #          /
 #        +z
-grid_num = 128
-surface_grid_num = 80
-quality = 1
-particle_num = 30000
 
-write_ply = 1
+# 默认配置，可以被JSON配置文件和命令行参数覆盖
+default_config = {
+    'arch': 'gpu',
+    'cpu_threads': 0,
+    'scene': 'cube',
+    'grid_num': 128,
+    'surface_grid_num': 80,
+    'particle_num': 30000,
+    'tension_coefficient': 0.07,
+    # 半隐式表面张力，配合自适应时间步长时不再受毛细波时间步长限制
+    'implicit_tension': False,
+    'adaptive_dt': False,
+    'start_frame': 1,
+    'end_frame': 500,
+    'output_dir': 'output',
+    'write_ply': 1,
+    # 每隔checkpoint_interval帧保存一次检查点，0表示不保存；resume不为空时从该检查点继续，
+    # 继续时tension_coefficient等参数以当前配置为准
+    'checkpoint_interval': 50,
+    'resume': None,
+    # 是否记录各阶段耗时，结束时在输出目录写出每帧统计和Chrome trace
+    'profile': False,
+}
+
+
+# 场景：在求解器中加入初始粒子
+def scene_cube(ti, solver, particle_num):
+    solver.add_cube(ti.Vector([0.35, 0.5, 0.35]), 0.23, particle_num, solver.material_water)
+
+
+def scene_dam_break(ti, solver, particle_num):
+    solver.add_cube(ti.Vector([0.05, 0.05, 0.05]), 0.4, particle_num, solver.material_water)
+
+
+def scene_two_drops(ti, solver, particle_num):
+    solver.add_cube(ti.Vector([0.2, 0.55, 0.35]), 0.18, particle_num // 2, solver.material_water)
+    solver.add_cube(ti.Vector([0.6, 0.35, 0.45]), 0.18, particle_num - particle_num // 2, solver.material_water)
+
+
+scenes = {
+    'cube': scene_cube,
+    'dam_break': scene_dam_break,
+    'two_drops': scene_two_drops,
+}
+
+
+def run(config):
+    # 每个进程初始化自己的Taichi运行时
+    import taichi as ti
+    from mpm_solver import MPMSolver
+
+    # 只在指定了线程数时传入，ti.init不接受None
+    init_kwargs = {'cpu_max_num_threads': config['cpu_threads']} if config['cpu_threads'] else {}
+    ti.init(arch=getattr(ti, config['arch']), **init_kwargs)
+    output_dir = config['output_dir']
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, 'config.json'), 'w') as f:
+        json.dump(config, f, indent=2)
+
+    mpm_solver = MPMSolver(config['particle_num'], surface_grid_num=config['surface_grid_num'],
+                           grid_num=config['grid_num'], tension_coefficient=config['tension_coefficient'],
+                           implicit_tension=config['implicit_tension'], adaptive_dt=config['adaptive_dt'],
+                           output_dir=output_dir, profile=config['profile'])
+    # # 将三角面片信息给碰撞检测算法，并初始化。
+    # # 将流体表面所用到的marching cube初始化
+    mpm_solver.init_surface()
+
+    frame_id = config['start_frame'] - 1
+    if config['resume']:
+        frame_id = mpm_solver.load_checkpoint(config['resume'])
+    else:
+        scenes[config['scene']](ti, mpm_solver, config['particle_num'])
+
+    checkpoint_interval = config['checkpoint_interval']
+    while frame_id < config['end_frame']:
+        frame_id += 1
+        print(output_dir, frame_id)
+        mpm_solver.run(frame_id, config['write_ply'])
+        if config['profile']:
+            print(' '.join('{} {:.1f}ms'.format(name, t * 1000) for name, t in mpm_solver.stats['stages'].items()))
+        if checkpoint_interval and frame_id % checkpoint_interval == 0:
+            mpm_solver.save_checkpoint(
+                os.path.join(output_dir, 'checkpoints', 'checkpoint_{:06d}.npz'.format(frame_id)), frame_id)
+    mpm_solver.close()
+    if config['profile']:
+        mpm_solver.profiler.write_json(os.path.join(output_dir, 'stats.json'))
+        mpm_solver.profiler.write_chrome_trace(os.path.join(output_dir, 'trace.json'))
+    return output_dir
+
+
+def convert(key, value):
+    default = default_config[key]
+    if isinstance(default, bool):
+        return value.lower() in ('1', 'true', 'yes')
+    if default is None:
+        return value
+    return type(default)(value)
+
+
+# 扫描参数形如 tension_coefficient=0.05,0.07，多个参数取笛卡尔积
+def parse_sweep(items):
+    keys, values = [], []
+    for item in items:
+        key, _, value = item.partition('=')
+        if key not in default_config:
+            raise ValueError('unknown sweep parameter: {}'.format(key))
+        keys.append(key)
+        values.append([convert(key, v) for v in value.split(',')])
+    return [dict(zip(keys, combination)) for combination in itertools.product(*values)]
+
+
+def sweep_configs(base, variants):
+    configs = []
+    for variant in variants:
+        config = dict(base)
+        config.update(variant)
+        name = '_'.join('{}{}'.format(key, value) for key, value in variant.items())
+        config['output_dir'] = os.path.join(base['output_dir'], name)
+        configs.append(config)
+    return configs
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='MPM surface tension simulation')
+    parser.add_argument('--config', help='JSON配置文件，键名与命令行参数相同')
+    parser.add_argument('--arch', choices=['cpu', 'gpu', 'cuda', 'vulkan', 'metal', 'opengl'])
+    parser.add_argument('--cpu-threads', type=int, help='CPU后端的线程数，0表示使用默认值')
+    parser.add_argument('--scene', choices=sorted(scenes))
+    parser.add_argument('--grid-num', type=int)
+    parser.add_argument('--surface-grid-num', type=int)
+    parser.add_argument('--particle-num', type=int)
+    parser.add_argument('--tension-coefficient', type=float)
+    parser.add_argument('--implicit-tension', action='store_true', default=None)
+    parser.add_argument('--adaptive-dt', action='store_true', default=None)
+    parser.add_argument('--start-frame', type=int)
+    parser.add_argument('--end-frame', type=int)
+    parser.add_argument('--output-dir')
+    parser.add_argument('--write-ply', type=int)
+    parser.add_argument('--checkpoint-interval', type=int)
+    parser.add_argument('--resume')
+    parser.add_argument('--profile', action='store_true', default=None)
+    parser.add_argument('--sweep', nargs='+', metavar='KEY=V1,V2',
+                        help='扫描模式：每组参数组合在进程池中单独运行，输出到output_dir下的子目录')
+    parser.add_argument('--workers', type=int, default=1, help='扫描模式下同时运行的进程数')
+    return parser.parse_args()
+
 
-mpm_solver = MPMSolver(particle_num, surface_grid_num=surface_grid_num, grid_num=grid_num)
-# # 将三角面片信息给碰撞检测算法，并初始化。
-# # 将流体表面所用到的marching cube初始化
-mpm_solver.init_surface()
+def main():
+    args = parse_args()
+    config = dict(default_config)
+    if args.config:
+        with open(args.config) as f:
+            file_config = json.load(f)
+        unknown = set(file_config) - set(default_config) - {'sweep'}
+        if unknown:
+            raise ValueError('unknown config keys: {}'.format(', '.join(sorted(unknown))))
+        config.update(file_config)
+    config.update({key: value for key, value in vars(args).items() if key in default_config and value is not None})
 
-mpm_solver.add_cube(ti.Vector([0.35, 0.5, 0.35]), 0.23, particle_num, 0)
+    file_sweep = config.pop('sweep', None)
+    sweep = args.sweep or file_sweep
+    if not sweep:
+        run(config)
+        return
+    # 配置文件中的sweep可以是参数组合的列表，也可以和命令行一样是KEY=V1,V2字符串列表
+    variants = parse_sweep(sweep) if all(isinstance(item, str) for item in sweep) else sweep
+    configs = sweep_configs(config, variants)
+    # spawn启动的进程互不共享Taichi运行时
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=context) as executor:
+        futures = [executor.submit(run, c) for c in configs]
+        for future in as_completed(futures):
+            print('finished', future.result())
 
-frame_id = 0
 
-while frame_id < 500:
-    # while frame_id < 500:
-    frame_id += 1
-    print(frame_id)
-    mpm_solver.run(frame_id, write_ply)
\ No newline at end of file
+if __name__ == '__main__':
+    main()
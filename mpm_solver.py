@@ -1,6 +1,16 @@
+import contextlib
+import json
+import math
+import os
+import warnings
+
+import numpy as np
 import taichi as ti
 
 from fluid_surface import FluidSurface
+from frame_exporter import FrameExporter, MeshExporter
+from profiler import Profiler
+from trajectory import TrajectoryWriter
 
 
 @ti.data_oriented
@@ -14,27 +24,116 @@ class MPMSolver:
     mark_fluid = 3
     mark_air = 0
 
+    # 表面张力计算方式：表面粒子（Marching Cube + 三角形离散，参考实现）或网格CSF
+    tension_particle = 0
+    tension_csf = 1
+
     def __init__(self,
                  max_particle_num,
                  grid_num,
-                 surface_grid_num
+                 surface_grid_num,
+                 sparse_surface=False,
+                 redistance_surface=False,
+                 lazy_surface_stencil=False,
+                 incremental_surface=False,
+                 mass_surface=False,
+                 tension_mode=tension_particle,
+                 tension_coefficient=0.07,
+                 surface_interval=1,
+                 surface_motion_threshold=0.0,
+                 advect_tension=False,
+                 surface_band_particles=False,
+                 implicit_tension=False,
+                 implicit_max_iterations=50,
+                 implicit_tolerance=1e-4,
+                 sparse_grid=False,
+                 grid_block_size=8,
+                 sort_interval=0,
+                 sort_block_size=4,
+                 adaptive_dt=False,
+                 cfl=0.5,
+                 fused_substep=True,
+                 output_dir='output',
+                 export_format='ply',
+                 export_surface=False,
+                 surface_export_format='ply',
+                 surface_normals=True,
+                 trajectory_dir=None,
+                 trajectory_chunk_frames=32,
+                 profile=False
                  ):
         self.surface_grid_num = surface_grid_num
+        # 表面level set是否使用稀疏窄带存储，较大的surface_grid_num（256以上）时开启
+        self.sparse_surface = sparse_surface
+        # 构建level set后是否重新距离化，得到满足|∇φ|=1的SDF
+        self.redistance_surface = redistance_surface
+        # 粒子球union得到的SDF在液体内部不会小于-radius，CSF、液面附近粒子分类和半隐式张力的delta
+        # 按φ判断窄带时会覆盖整个液体，因此这些模式总是重新距离化（由网格质量构建的液面本身已经重新距离化）
+        if tension_mode == self.tension_csf or surface_band_particles or implicit_tension:
+            self.redistance_surface = True
+        # 不存储表面网格上的梯度和拉普拉斯，只在采样点处现场计算
+        self.lazy_surface_stencil = lazy_surface_stencil
+        # 增量更新level set：只重算粒子移动过的block，液面没有变化时跳过Marching Cube和表面张力计算
+        self.incremental_surface = incremental_surface
+        # 直接在MPM背景网格上由上一个子步P2G得到的节点质量构建液面，不再单独遍历粒子，
+        # 表面网格与MPM网格重合，surface_grid_num不再使用
+        self.mass_surface = mass_surface
+        if self.mass_surface and (self.sparse_surface or self.incremental_surface):
+            raise ValueError('mass_surface cannot be combined with sparse_surface or incremental_surface')
+        # 增量level set只在稠密存储上维护粒子球union，不能重新距离化，也就不能用于需要SDF的模式
+        if self.incremental_surface:
+            conflicts = [name for name, enabled in (
+                ('sparse_surface', sparse_surface),
+                ('redistance_surface', redistance_surface),
+                ('tension_mode=tension_csf', tension_mode == self.tension_csf),
+                ('surface_band_particles', surface_band_particles),
+                ('implicit_tension', implicit_tension),
+            ) if enabled]
+            if conflicts:
+                raise ValueError('incremental_surface cannot be combined with {}'.format(', '.join(conflicts)))
         self.max_particle_num = max_particle_num
         self.grid_num = grid_num
         self.dx = 1 / self.grid_num
-        self.surface_dx = 1 / self.surface_grid_num
+        self.surface_dx = self.dx if self.mass_surface else 1 / self.surface_grid_num
         self.inv_dx = float(self.grid_num)
         self.dt = 1e-4
         self.steps = 32
+        self.frame_dt = self.dt * self.steps
+        # 当前子步实际使用的时间步长，自适应模式下每个子步重新计算
+        self.substep_dt = ti.field(ti.f32, shape=())
         self.p_vol = (self.dx * 0.5) ** 2
+        self.rho = 1
         self.bound = 3
         self.E = 1000
         self.nu = 0.2
         self.mu_0 = self.E / (2 * (1 + self.nu))
         self.lambda_0 = self.E * self.nu / ((1 + self.nu) * (1 - 2 * self.nu))
+        # 自适应时间步长：由CFL条件、弹性波速和毛细波共同限制，每帧走完frame_dt
+        self.adaptive_dt = adaptive_dt
+        self.cfl = cfl
+        self.min_dt = 1e-6
+        self.max_speed = ti.field(ti.f32, shape=())
+        self.dt_history = []
+        # 是否把子步的MPM部分合并为一个kernel启动
+        self.fused_substep = fused_substep
+        # 每帧粒子位置的导出目录和格式（ply为二进制PLY，raw为小端float32数组），第一次导出时创建后台写出线程
+        self.output_dir = output_dir
+        self.export_format = export_format
+        self.exporter = None
+        # 是否每帧导出液面网格（二进制PLY或OBJ，顶点共享，可带法线）
+        self.export_surface = export_surface
+        self.surface_export_format = surface_export_format
+        self.surface_normals = surface_normals
+        self.mesh_exporter = None
+        # 轨迹存档目录，不为空时每帧把粒子位置和速度按粒子编号追加到分块存档
+        self.trajectory_dir = trajectory_dir
+        self.trajectory_chunk_frames = trajectory_chunk_frames
+        self.trajectory_writer = None
+        # 是否记录各阶段耗时和计数器，开启后子步按阶段分别启动kernel，每帧的统计记录在self.stats中
+        self.profiler = Profiler() if profile else None
+        self.stats = None
 
-        self.particles = ti.Struct.field({
+        particle_members = {
             "position": ti.types.vector(3, ti.f32),
             "velocity": ti.types.vector(3, ti.f32),
             "F": ti.types.matrix(3, 3, ti.f32),
@@ -42,21 +141,130 @@ class MPMSolver:
             "Jp": ti.f32,
             "mass": ti.f32,
             "material": ti.i32,
-            "color": ti.types.vector(3, ti.f32)
-        }, shape=self.max_particle_num)
+            "color": ti.types.vector(3, ti.f32),
+            # 创建时的粒子编号，排序后保持不变
+            "id": ti.i32
+        }
+        self.particles = ti.Struct.field(particle_members, shape=self.max_particle_num)
 
-        self.node = ti.Struct.field({
-            "node_m": ti.f32,
-            "node_v": ti.types.vector(3, ti.f32),
-            "tension": ti.types.vector(3, ti.f32),
-        }, shape=(self.grid_num,) * 3)
+        # 每隔sort_interval个子步按粒子所在的网格block做计数排序，使P2G/G2P访问的网格节点在内存上连续，0表示不排序
+        self.sort_interval = sort_interval
+        self.sort_block_size = sort_block_size
+        self.sort_bin_per_axis = -(-self.grid_num // self.sort_block_size)
+        self.substep_index = 0
+        if self.sort_interval > 0:
+            self.particle_buffer = ti.Struct.field(particle_members, shape=self.max_particle_num)
+            self.sort_key = ti.field(ti.i32, shape=self.max_particle_num)
+            self.sort_rank = ti.field(ti.i32, shape=self.max_particle_num)
+            self.sort_bin_offset = ti.field(ti.i32, shape=self.sort_bin_per_axis ** 3)
+
+        # 稀疏背景网格：P2G时由粒子激活block，网格操作只遍历激活的block，每个子步开始时释放。
+        # 表面张力放在单独的稀疏树上，两次液面重建之间可以保留
+        self.sparse_grid = sparse_grid
+        self.grid_block_size = grid_block_size
+        if self.sparse_grid:
+            self.node = ti.Struct.field({
+                "node_m": ti.f32,
+                "node_v": ti.types.vector(3, ti.f32),
+                "tension": ti.types.vector(3, ti.f32),
+            })
+            grid_block_num = -(-self.grid_num // self.grid_block_size)
+            self.grid_block = ti.root.pointer(ti.ijk, grid_block_num)
+            self.grid_leaf = self.grid_block.bitmasked(ti.ijk, self.grid_block_size)
+            self.grid_leaf.place(self.node.node_m, self.node.node_v)
+            self.tension_block = ti.root.pointer(ti.ijk, grid_block_num)
+            self.tension_leaf = self.tension_block.bitmasked(ti.ijk, self.grid_block_size)
+            self.tension_leaf.place(self.node.tension)
+        else:
+            self.node = ti.Struct.field({
+                "node_m": ti.f32,
+                "node_v": ti.types.vector(3, ti.f32),
+                "tension": ti.types.vector(3, ti.f32),
+            }, shape=(self.grid_num,) * 3)
 
         self.neighbour = (3,) * 3
         self.create_particle_num = ti.field(ti.i32, shape=())
+        # 每种材料的粒子编号列表
+        self.material_particle_num = ti.field(ti.i32, shape=3)
+        self.material_index = ti.field(ti.i32, shape=(3, self.max_particle_num))
+
+        if self.mass_surface:
+            self.fluid_surface_solver = FluidSurface(grid_num=self.grid_num, particle_type=self.material_water,
+                                                     radius=self.dx * 0.8, dx=self.dx, redistance=True,
+                                                     lazy_stencil=self.lazy_surface_stencil,
+                                                     sample_spacing=self.dx * 0.5)
+        else:
+            self.fluid_surface_solver = FluidSurface(grid_num=self.surface_grid_num,
+                                                     particle_type=self.material_water,
+                                                     radius=self.surface_dx * 0.8, sparse=self.sparse_surface,
+                                                     redistance=self.redistance_surface,
+                                                     lazy_stencil=self.lazy_surface_stencil,
+                                                     incremental=self.incremental_surface,
+                                                     max_particle_num=self.max_particle_num,
+                                                     sample_spacing=self.dx * 0.5)
+        self.tension_coefficient = tension_coefficient
+        self.tension_mode = tension_mode
+        # CSF光滑delta函数的半宽，至少覆盖1.5个MPM网格和1.5个表面网格
+        self.csf_width = 1.5 * max(self.dx, self.surface_dx)
 
-        self.fluid_surface_solver = FluidSurface(grid_num=self.surface_grid_num, particle_type=self.material_water,
-                                                 radius=self.surface_dx * 0.8)
-        self.tension_coefficient = 0.07
+        # 液面重建间隔（子步数），设为self.steps即每帧重建一次，期间复用网格上缓存的表面张力
+        self.surface_interval = surface_interval
+        # 粒子相对上次重建的最大位移超过该值（表面网格数）时提前重建，0表示不检测
+        self.surface_motion_threshold = surface_motion_threshold
+        # 两次重建之间是否用网格速度对缓存的表面张力做半拉格朗日平流
+        self.advect_tension = advect_tension
+        self.substeps_since_surface = None
+        self.surface_built_particle_num = 0
+        # 增量模式下导出网格时更新了level set，下次重建需要重新计算表面张力
+        self.surface_tension_stale = False
+        if self.surface_motion_threshold > 0:
+            self.surface_reference_position = ti.Vector.field(3, ti.f32, shape=self.max_particle_num)
+            self.max_displacement = ti.field(ti.f32, shape=())
+        if self.advect_tension:
+            if self.sparse_grid:
+                self.tension_buffer = ti.Vector.field(3, ti.f32)
+                self.tension_leaf.place(self.tension_buffer)
+            else:
+                self.tension_buffer = ti.Vector.field(3, ti.f32, shape=(self.grid_num,) * 3)
+        # 只对液面附近的粒子收集网格上的表面张力。重建液面时按插值SDF（已重新距离化）把粒子分类为紧凑的编号列表，
+        # 带宽覆盖张力非零的节点再加上粒子的插值半径（1.5个网格）
+        self.surface_band_particles = surface_band_particles
+        if self.tension_mode == self.tension_csf:
+            self.surface_band_width = self.csf_width + 2.0 * self.dx
+        else:
+            self.surface_band_width = 3.5 * self.dx
+        if self.surface_band_particles:
+            self.band_particle_num = ti.field(ti.i32, shape=())
+            self.band_particle_index = ti.field(ti.i32, shape=self.max_particle_num)
+
+        # 半隐式表面张力（Hysing）：液面在dt后的位置x + dt * v处的曲率近似为κn + dt * Δv，
+        # 对速度的拉普拉斯项隐式求解，在网格上用无矩阵共轭梯度法求解
+        # m_i v_i + dt² Σ_j w_ij (v_i - v_j) = m_i (v*_i + dt * tension_i)，
+        # 只耦合质量非零的6邻域节点，w_ij = σ (δ_i + δ_j)(m_i + m_j) / (4 dx)，与显式张力的单位一致。
+        # 开启后不再受毛细波时间步长限制，表面张力直接加在网格速度上，而不是P2G时加到粒子上
+        self.implicit_tension = implicit_tension
+        if self.implicit_tension and self.surface_band_particles:
+            raise ValueError('implicit_tension applies tension on the grid and cannot use surface_band_particles')
+        self.implicit_max_iterations = implicit_max_iterations
+        self.implicit_tolerance = implicit_tolerance
+        # 最后一个子步的迭代次数和相对残差，以及本帧每个子步的(迭代次数, 相对残差)
+        self.implicit_iterations = 0
+        self.implicit_residual = 0.0
+        self.implicit_history = []
+        if self.implicit_tension:
+            self.cg_r = ti.Vector.field(3, ti.f32)
+            self.cg_p = ti.Vector.field(3, ti.f32)
+            self.cg_Ap = ti.Vector.field(3, ti.f32)
+            self.tension_delta = ti.field(ti.f32)
+            if self.sparse_grid:
+                self.grid_leaf.place(self.cg_r, self.cg_p, self.cg_Ap)
+                self.tension_leaf.place(self.tension_delta)
+            else:
+                ti.root.dense(ti.ijk, self.grid_num).place(self.cg_r, self.cg_p, self.cg_Ap, self.tension_delta)
+            self.cg_rr = ti.field(ti.f32, shape=())
+            self.cg_rr_new = ti.field(ti.f32, shape=())
+            self.cg_pAp = ti.field(ti.f32, shape=())
+            self.cg_b_norm = ti.field(ti.f32, shape=())
 
     # 初始化碰撞检测类的顶点信息和顶点坐标信息
     def init_surface(self):
@@ -65,85 +273,173 @@ class MPMSolver:
         # 初始化之后的赋值
         self.fluid_surface_solver.numpy_to_field()
 
+    @ti.func
+    def reset_node_stage(self):
+        if ti.static(self.sparse_grid):
+            for I in ti.grouped(self.grid_block):
+                ti.deactivate(self.grid_block, I)
+        else:
+            for I in ti.grouped(self.node):
+                self.node[I].node_v = ti.zero(self.node[I].node_v)
+                self.node[I].node_m = 0
+
+    # 清空网格上的表面张力
+    @ti.func
+    def reset_node_tension(self):
+        if ti.static(self.sparse_grid):
+            for I in ti.grouped(self.tension_block):
+                ti.deactivate(self.tension_block, I)
+        else:
+            for I in ti.grouped(self.node):
+                self.node[I].tension = [0.0, 0.0, 0.0]
+
+    # 按材料建立粒子编号列表，P2G对每种材料使用专门的kernel，避免同一循环内按材料分支
     @ti.kernel
-    def reset_node(self):
-        for I in ti.grouped(self.node):
-            self.node[I].node_v = ti.zero(self.node[I].node_v)
-            self.node[I].node_m = 0
+    def build_material_index(self):
+        for m in self.material_particle_num:
+            self.material_particle_num[m] = 0
+        for p in range(self.create_particle_num[None]):
+            m = self.particles[p].material
+            n = ti.atomic_add(self.material_particle_num[m], 1)
+            self.material_index[m, n] = p
+
+    # 用给定的二次B样条权重把网格节点的表面张力加到粒子速度上
+    @ti.func
+    def gather_tension_weighted(self, p, base, w0, w1, w2):
+        w = [w0, w1, w2]
+        tension = ti.Vector([0.0, 0.0, 0.0])
+        for offset in ti.static(ti.grouped(ti.ndrange(*self.neighbour))):
+            weight = 1.0
+            for i in ti.static(range(3)):
+                weight *= w[offset[i]][i]
+            tension += weight * self.node[base + offset].tension
+        self.particles[p].velocity += tension * self.substep_dt[None]
+
+    # 单独收集表面张力时自己计算权重
+    @ti.func
+    def gather_tension(self, p):
+        Xp = self.particles[p].position / self.dx
+        base = int(Xp - 0.5)
+        fx = Xp - base
+        self.gather_tension_weighted(p, base, 0.5 * (1.5 - fx) ** 2, 0.75 - (fx - 1) ** 2, 0.5 * (fx - 0.5) ** 2)
+
+    # 按液面附近粒子列表收集表面张力，只在开启surface_band_particles时使用
+    @ti.func
+    def gather_band_tension_stage(self):
+        for n in range(self.band_particle_num[None]):
+            self.gather_tension(self.band_particle_index[n])
 
-    # 将网格节点的表面张力映射给流体粒子。
+    # 把插值SDF大于-surface_band_width的粒子（包括液面外的粒子）放入列表
     @ti.kernel
-    def add_tension_to_particle(self):
+    def classify_band_particles(self):
+        self.band_particle_num[None] = 0
         for p in range(self.create_particle_num[None]):
-            base = (self.particles[p].position * self.inv_dx - 0.5).cast(int)
-            fx = self.particles[p].position * self.inv_dx - base.cast(float)
-            # Quadratic kernels  [http://mpm.graphics   Eqn. 123, with x=fx, fx-1,fx-2]
-            w = [0.5 * (1.5 - fx) ** 2, 0.75 - (fx - 1) ** 2, 0.5 * (fx - 0.5) ** 2]
-            for offset in ti.static(ti.grouped(ti.ndrange(*self.neighbour))):
-                weight = 1.0
-                for i in ti.static(range(3)):
-                    weight *= w[offset[i]][i]
-                tension = self.node[base + offset].tension
-                self.particles[p].velocity += weight * tension
+            phi = self.fluid_surface_solver.linear_interpolation_sdf(self.particles[p].position)
+            if phi > -self.surface_band_width:
+                n = ti.atomic_add(self.band_particle_num[None], 1)
+                self.band_particle_index[n] = p
+
+    # 先将网格节点的表面张力映射给粒子，再将粒子的动量和质量映射到网格，两者共用同一组权重
+    @ti.func
+    def scatter_particle(self, p, stress):
+        Xp = self.particles[p].position / self.dx
+        base = int(Xp - 0.5)
+        fx = Xp - base
+        w = [0.5 * (1.5 - fx) ** 2, 0.75 - (fx - 1) ** 2, 0.5 * (fx - 0.5) ** 2]
+        if ti.static(not self.surface_band_particles and not self.implicit_tension):
+            self.gather_tension_weighted(p, base, w[0], w[1], w[2])
 
+        stress = (-self.substep_dt[None] * self.p_vol * 4) * stress / self.dx ** 2
+        affine = stress + self.particles[p].mass * self.particles[p].C
+        for offset in ti.static(ti.grouped(ti.ndrange(*self.neighbour))):
+            dpos = (offset - fx) * self.dx
+            weight = 1.0
+            for i in ti.static(range(3)):
+                weight *= w[offset[i]][i]
+            self.node[base + offset].node_v += weight * (
+                    self.particles[p].mass * self.particles[p].velocity + affine @ dpos)
+            self.node[base + offset].node_m += weight * self.particles[p].mass
+
+    # 只把粒子质量映射到网格。由网格质量构建液面时，新加入粒子或从检查点恢复后还没有执行过P2G，
+    # 第一次重建前用它得到节点质量，不改变粒子的速度和形变梯度
     @ti.kernel
-    def P2G(self):
+    def scatter_mass(self):
+        self.reset_node_stage()
         for p in range(self.create_particle_num[None]):
             Xp = self.particles[p].position / self.dx
             base = int(Xp - 0.5)
             fx = Xp - base
             w = [0.5 * (1.5 - fx) ** 2, 0.75 - (fx - 1) ** 2, 0.5 * (fx - 0.5) ** 2]
-            self.particles[p].F = (ti.Matrix.identity(float, 3) + self.dt * self.particles[p].C) @ self.particles[p].F
-
-            h = ti.exp(10 * (1.0 - self.particles[p].Jp))  # Hardening coefficient: snow gets harder when compressed
-            if self.particles[p].material == self.material_solid:  # jelly, make it softer
-                h = 0.3
-            mu, la = self.mu_0 * h, self.lambda_0 * h
-            if self.particles[p].material == self.material_water:  # liquid
-                mu = 0.0
-            U, sig, V = ti.svd(self.particles[p].F)
-            J = 1.0
-            for d in ti.static(range(3)):
-                new_sig = sig[d, d]
-                if self.particles[p].material == self.material_snow:  # Snow
-                    new_sig = min(max(sig[d, d], 1 - 2.5e-2),
-                                  1 + 4.5e-3)  # Plasticity
-                self.particles[p].Jp *= sig[d, d] / new_sig
-                sig[d, d] = new_sig
-                J *= new_sig
-            if self.particles[p].material == self.material_water:
-                new_F = ti.Matrix.identity(float, 3)
-                new_F[0, 0] = J
-                self.particles[p].F = new_F
-            elif self.particles[p].material == self.material_snow:
-                self.particles[
-                    p].F = U @ sig @ V.transpose()  # Reconstruct elastic deformation gradient after plasticity
-            stress = 2 * mu * (self.particles[p].F - U @ V.transpose()) @ self.particles[p].F.transpose(
-            ) + ti.Matrix.identity(float, 3) * la * J * (J - 1)
-            stress = (-self.dt * self.p_vol * 4) * stress / self.dx ** 2
-            affine = stress + self.particles[p].mass * self.particles[p].C
-
             for offset in ti.static(ti.grouped(ti.ndrange(*self.neighbour))):
-                dpos = (offset - fx) * self.dx
                 weight = 1.0
                 for i in ti.static(range(3)):
                     weight *= w[offset[i]][i]
-                self.node[base + offset].node_v += weight * (
-                        self.particles[p].mass * self.particles[p].velocity + affine @ dpos)
                 self.node[base + offset].node_m += weight * self.particles[p].mass
 
-    @ti.kernel
-    def grid_operator(self):
-        for I in ti.grouped(self.node):
+    def P2G(self):
+        self.P2G_water()
+        self.P2G_elastic()
+
+    # 水的mu为0，F退化为只记录体积比J（保存在F[0, 0]），J直接由det(I + dt * C)更新，不需要SVD和硬化系数
+    @ti.func
+    def P2G_water_stage(self):
+        for n in range(self.material_particle_num[self.material_water]):
+            p = self.material_index[self.material_water, n]
+            J = (ti.Matrix.identity(float, 3) + self.substep_dt[None] * self.particles[p].C).determinant() * \
+                self.particles[p].F[0, 0]
+            new_F = ti.Matrix.identity(float, 3)
+            new_F[0, 0] = J
+            self.particles[p].F = new_F
+            stress = ti.Matrix.identity(float, 3) * self.lambda_0 * J * (J - 1)
+            self.scatter_particle(p, stress)
+
+    # 果冻和雪使用完整的SVD本构
+    @ti.func
+    def P2G_elastic_stage(self):
+        for material in ti.static((self.material_solid, self.material_snow)):
+            for n in range(self.material_particle_num[material]):
+                p = self.material_index[material, n]
+                self.particles[p].F = (ti.Matrix.identity(float, 3) +
+                                       self.substep_dt[None] * self.particles[p].C) @ self.particles[p].F
+
+                h = 0.3  # jelly, make it softer
+                if ti.static(material == self.material_snow):
+                    h = ti.exp(10 * (1.0 - self.particles[p].Jp))  # Hardening coefficient: snow gets harder when compressed
+                mu, la = self.mu_0 * h, self.lambda_0 * h
+                U, sig, V = ti.svd(self.particles[p].F)
+                J = 1.0
+                for d in ti.static(range(3)):
+                    new_sig = sig[d, d]
+                    if ti.static(material == self.material_snow):  # Snow
+                        new_sig = min(max(sig[d, d], 1 - 2.5e-2),
+                                      1 + 4.5e-3)  # Plasticity
+                    self.particles[p].Jp *= sig[d, d] / new_sig
+                    sig[d, d] = new_sig
+                    J *= new_sig
+                if ti.static(material == self.material_snow):
+                    self.particles[
+                        p].F = U @ sig @ V.transpose()  # Reconstruct elastic deformation gradient after plasticity
+                stress = 2 * mu * (self.particles[p].F - U @ V.transpose()) @ self.particles[p].F.transpose(
+                ) + ti.Matrix.identity(float, 3) * la * J * (J - 1)
+                self.scatter_particle(p, stress)
+
+    @ti.func
+    def grid_operator_stage(self):
+        # 稀疏模式下只遍历P2G激活的节点
+        for I in ti.grouped(self.node.node_m):
             if self.node[I].node_m > 0:
                 self.node[I].node_v /= self.node[I].node_m
-            self.node[I].node_v += self.dt * ti.Vector([0.0, -9.8, 0.0])
-            cond = I < self.bound and self.node[I].node_v < 0 or I > self.grid_num - self.bound and self.node[
-                I].node_v > 0
-            self.node[I].node_v = 0 if cond else self.node[I].node_v
+            self.node[I].node_v += self.substep_dt[None] * ti.Vector([0.0, -9.8, 0.0])
+            self.grid_boundary(I)
 
-    @ti.kernel
-    def G2P(self):
+    @ti.func
+    def grid_boundary(self, I):
+        cond = I < self.bound and self.node[I].node_v < 0 or I > self.grid_num - self.bound and self.node[
+            I].node_v > 0
+        self.node[I].node_v = 0 if cond else self.node[I].node_v
+
+    @ti.func
+    def G2P_stage(self):
         for p in range(self.create_particle_num[None]):
             Xp = self.particles[p].position / self.dx
             base = int(Xp - 0.5)
@@ -161,14 +457,49 @@ class MPMSolver:
                 new_C += 4 * weight * g_v.outer_product(dpos) / self.dx ** 2
 
             self.particles[p].velocity = new_v
-            self.particles[p].position += self.dt * self.particles[p].velocity
+            self.particles[p].position += self.substep_dt[None] * self.particles[p].velocity
             self.particles[p].C = new_C
 
-    # 根据插值函数求出每个表面粒子处的表面张力带来的速度，然后映射到网格节点
+    @ti.kernel
+    def reset_node(self):
+        self.reset_node_stage()
+
+    @ti.kernel
+    def gather_band_tension(self):
+        self.gather_band_tension_stage()
+
+    @ti.kernel
+    def P2G_water(self):
+        self.P2G_water_stage()
+
+    @ti.kernel
+    def P2G_elastic(self):
+        self.P2G_elastic_stage()
+
+    @ti.kernel
+    def grid_operator(self):
+        self.grid_operator_stage()
+
+    @ti.kernel
+    def G2P(self):
+        self.G2P_stage()
+
+    # 子步中MPM部分的各个阶段合并为一个kernel，阶段之间仍按顺序执行，
+    # 粒子数等都在设备端读取，一个子步只需启动一次kernel
+    @ti.kernel
+    def substep_kernel(self):
+        if ti.static(self.surface_band_particles):
+            self.gather_band_tension_stage()
+        self.reset_node_stage()
+        self.P2G_water_stage()
+        self.P2G_elastic_stage()
+        self.grid_operator_stage()
+        self.G2P_stage()
+
+    # 根据插值函数求出每个表面粒子处的表面张力带来的加速度，然后映射到网格节点，P2G时乘以时间步长加到粒子速度上
     @ti.kernel
     def add_tension(self):
-        for I in ti.grouped(self.node):
-            self.node[I].tension = [0.0, 0.0, 0.0]
+        self.reset_node_tension()
         for p in range(self.fluid_surface_solver.surface_particle_num[None]):
             Xp = self.fluid_surface_solver.surface_particles.position[p] / self.dx
             base = int(Xp - 0.5)
@@ -179,18 +510,358 @@ class MPMSolver:
                 self.fluid_surface_solver.surface_particles.position[p])
             curvature = self.fluid_surface_solver.linear_interpolation_curvature(
                 self.fluid_surface_solver.surface_particles.position[p])
-            tension = normal * curvature * self.tension_coefficient * self.dt
+            # 每个表面粒子代表的面积不同，按面积加权
+            area_weight = self.fluid_surface_solver.surface_particles.area[p] / \
+                self.fluid_surface_solver.sample_spacing ** 2
+            tension = normal * curvature * self.tension_coefficient * area_weight
             for offset in ti.static(ti.grouped(ti.ndrange(*self.neighbour))):
                 weight = 1.0
                 for i in ti.static(range(3)):
                     weight *= w[offset[i]][i]
                 self.node[base + offset].tension -= weight * tension
 
+    # CSF模型：直接在MPM网格节点上由SDF的法线、曲率和光滑delta函数计算表面张力，
+    # 不需要Marching Cube和表面粒子。delta乘以dx后沿液面法向求和约为1，
+    # 与一个表面粒子映射到网格上的权重和同量级
+    @ti.kernel
+    def add_tension_csf(self):
+        self.reset_node_tension()
+        # 只写入液面附近的节点，稀疏模式下只激活这些节点
+        for I in ti.grouped(ti.ndrange(self.grid_num, self.grid_num, self.grid_num)):
+            node_pos = I * self.dx
+            phi = self.fluid_surface_solver.linear_interpolation_sdf(node_pos)
+            if abs(phi) < self.csf_width:
+                delta = 0.5 * (1.0 + ti.cos(math.pi * phi / self.csf_width)) / self.csf_width
+                normal = self.fluid_surface_solver.linear_interpolation_normal(node_pos)
+                curvature = self.fluid_surface_solver.linear_interpolation_curvature(node_pos)
+                self.node[I].tension = -normal * curvature * self.tension_coefficient * delta * self.dx
+
+    # 网格节点处的光滑delta函数，作为半隐式张力中每个节点所含的液面面积（δ dx³）
+    @ti.kernel
+    def compute_tension_delta(self):
+        for I in ti.grouped(ti.ndrange(self.grid_num, self.grid_num, self.grid_num)):
+            phi = self.fluid_surface_solver.linear_interpolation_sdf(I * self.dx)
+            if abs(phi) < self.csf_width:
+                self.tension_delta[I] = 0.5 * (1.0 + ti.cos(math.pi * phi / self.csf_width)) / self.csf_width
+            elif ti.static(not self.sparse_grid):
+                self.tension_delta[I] = 0.0
+
+    @ti.func
+    def implicit_weight(self, I, J):
+        return self.tension_coefficient * (self.tension_delta[I] + self.tension_delta[J]) * (
+                self.node[I].node_m + self.node[J].node_m) / (4 * self.dx)
+
+    # A x = m_i x_i + dt² Σ_j w_ij (x_i - x_j)
+    @ti.func
+    def implicit_operator(self, x: ti.template(), I):
+        dt = self.substep_dt[None]
+        result = self.node[I].node_m * x[I]
+        # 只要w_ij非零就在两行中都计入，保证算子对称
+        for d in ti.static(range(3)):
+            for s in ti.static((-1, 1)):
+                J = I + s * ti.Vector.unit(3, d, ti.i32)
+                if 0 <= J[d] < self.grid_num:
+                    if self.node[J].node_m > 0:
+                        weight = self.implicit_weight(I, J)
+                        if weight > 0:
+                            result += dt * dt * weight * (x[I] - x[J])
+        return result
+
+    # 初始解为显式张力更新后的速度，r = b - A x，p = r
+    @ti.kernel
+    def implicit_init(self):
+        dt = self.substep_dt[None]
+        self.cg_rr[None] = 0.0
+        self.cg_b_norm[None] = 0.0
+        for I in ti.grouped(self.node.node_m):
+            if self.node[I].node_m > 0:
+                self.node[I].node_v += dt * self.node[I].tension
+        for I in ti.grouped(self.node.node_m):
+            if self.node[I].node_m > 0:
+                b = self.node[I].node_m * self.node[I].node_v
+                # r暂存A x
+                self.cg_r[I] = b - self.implicit_operator(self.node.node_v, I)
+                self.cg_p[I] = self.cg_r[I]
+                self.cg_rr[None] += self.cg_r[I].norm_sqr()
+                self.cg_b_norm[None] += b.norm_sqr()
+
+    @ti.kernel
+    def implicit_apply(self):
+        self.cg_pAp[None] = 0.0
+        for I in ti.grouped(self.node.node_m):
+            if self.node[I].node_m > 0:
+                self.cg_Ap[I] = self.implicit_operator(self.cg_p, I)
+                self.cg_pAp[None] += self.cg_p[I].dot(self.cg_Ap[I])
+
+    @ti.kernel
+    def implicit_update_solution(self):
+        alpha = self.cg_rr[None] / ti.max(self.cg_pAp[None], 1e-30)
+        self.cg_rr_new[None] = 0.0
+        for I in ti.grouped(self.node.node_m):
+            if self.node[I].node_m > 0:
+                self.node[I].node_v += alpha * self.cg_p[I]
+                self.cg_r[I] -= alpha * self.cg_Ap[I]
+                self.cg_rr_new[None] += self.cg_r[I].norm_sqr()
+
+    @ti.kernel
+    def implicit_update_direction(self):
+        beta = self.cg_rr_new[None] / ti.max(self.cg_rr[None], 1e-30)
+        for I in ti.grouped(self.node.node_m):
+            if self.node[I].node_m > 0:
+                self.cg_p[I] = self.cg_r[I] + beta * self.cg_p[I]
+        self.cg_rr[None] = self.cg_rr_new[None]
+
+    @ti.kernel
+    def implicit_boundary(self):
+        for I in ti.grouped(self.node.node_m):
+            self.grid_boundary(I)
+
+    # 共轭梯度求解半隐式张力，速度直接在node_v上迭代，相对残差|r|/|b|小于implicit_tolerance时停止
+    def solve_implicit_tension(self):
+        self.implicit_init()
+        b_norm = math.sqrt(self.cg_b_norm[None])
+        residual = math.sqrt(self.cg_rr[None]) / b_norm if b_norm > 0 else 0.0
+        iterations = 0
+        while residual > self.implicit_tolerance and iterations < self.implicit_max_iterations:
+            self.implicit_apply()
+            self.implicit_update_solution()
+            self.implicit_update_direction()
+            iterations += 1
+            residual = math.sqrt(self.cg_rr[None]) / b_norm
+        self.implicit_boundary()
+        self.implicit_iterations = iterations
+        self.implicit_residual = residual
+        self.implicit_history.append((iterations, residual))
+
+    @ti.kernel
+    def compute_max_speed(self):
+        self.max_speed[None] = 0.0
+        for p in range(self.create_particle_num[None]):
+            ti.atomic_max(self.max_speed[None], self.particles[p].velocity.norm())
+
+    # 弹性波速的时间步长限制，只有水时剪切模量为0
+    def elastic_dt(self):
+        modulus = self.lambda_0
+        if self.material_particle_num[self.material_solid] + self.material_particle_num[self.material_snow] > 0:
+            modulus += 2 * self.mu_0
+        return self.cfl * self.dx / math.sqrt(modulus / self.rho)
+
+    # 毛细波的时间步长限制 dt < sqrt(rho * dx³ / (2π * sigma))
+    def capillary_dt(self):
+        if self.tension_coefficient <= 0 or self.implicit_tension:
+            return self.frame_dt
+        return math.sqrt(self.rho * self.dx ** 3 / (2 * math.pi * self.tension_coefficient))
+
+    def compute_adaptive_dt(self, wave_dt):
+        self.compute_max_speed()
+        dt = wave_dt
+        max_speed = self.max_speed[None]
+        if max_speed > 0:
+            dt = min(dt, self.cfl * self.dx / max_speed)
+        return max(dt, self.min_dt)
+
+    # 记录重建液面时的粒子位置，按粒子id存储，排序改变粒子编号后仍然有效
+    @ti.kernel
+    def store_surface_reference(self):
+        for p in range(self.create_particle_num[None]):
+            self.surface_reference_position[self.particles[p].id] = self.particles[p].position
+
+    @ti.kernel
+    def compute_max_displacement(self):
+        self.max_displacement[None] = 0.0
+        for p in range(self.create_particle_num[None]):
+            ti.atomic_max(self.max_displacement[None], (self.particles[p].position -
+                                                        self.surface_reference_position[self.particles[p].id]).norm())
+
+    # 三线性插值网格上缓存的表面张力
+    @ti.func
+    def interpolate_tension(self, pos):
+        Xp = pos * self.inv_dx
+        base = ti.min(ti.max(ti.floor(Xp).cast(int), 0), self.grid_num - 2)
+        fx = ti.min(ti.max(Xp - base.cast(float), 0.0), 1.0)
+        w = [1.0 - fx, fx]
+        result = ti.Vector([0.0, 0.0, 0.0])
+        for i, j, k in ti.static(ti.ndrange(2, 2, 2)):
+            result += self.tension_buffer[base + ti.Vector([i, j, k])] * w[i][0] * w[j][1] * w[k][2]
+        return result
+
+    # 用上一子步的网格速度对缓存的表面张力做半拉格朗日平流
+    @ti.kernel
+    def advect_node_tension(self):
+        for I in ti.grouped(self.node.tension):
+            self.tension_buffer[I] = self.node[I].tension
+        for I in ti.grouped(self.node.tension):
+            self.node[I].tension = self.interpolate_tension(I * self.dx - self.substep_dt[None] * self.node[I].node_v)
+
+    @ti.func
+    def copy_particle(self, dst: ti.template(), i, src: ti.template(), j):
+        dst[i].position = src[j].position
+        dst[i].velocity = src[j].velocity
+        dst[i].F = src[j].F
+        dst[i].C = src[j].C
+        dst[i].Jp = src[j].Jp
+        dst[i].mass = src[j].mass
+        dst[i].material = src[j].material
+        dst[i].color = src[j].color
+        dst[i].id = src[j].id
+
+    # 按粒子所在的block做计数排序
+    @ti.kernel
+    def sort_particles(self):
+        for b in self.sort_bin_offset:
+            self.sort_bin_offset[b] = 0
+        for p in range(self.create_particle_num[None]):
+            cell = ti.min(ti.max((self.particles[p].position * self.inv_dx).cast(int), 0), self.grid_num - 1)
+            block = cell // self.sort_block_size
+            key = (block[0] * self.sort_bin_per_axis + block[1]) * self.sort_bin_per_axis + block[2]
+            self.sort_key[p] = key
+            self.sort_rank[p] = ti.atomic_add(self.sort_bin_offset[key], 1)
+        offset = 0
+        ti.loop_config(serialize=True)
+        for b in range(self.sort_bin_per_axis ** 3):
+            count = self.sort_bin_offset[b]
+            self.sort_bin_offset[b] = offset
+            offset += count
+        for p in range(self.create_particle_num[None]):
+            self.copy_particle(self.particle_buffer, self.sort_bin_offset[self.sort_key[p]] + self.sort_rank[p],
+                               self.particles, p)
+        for p in range(self.create_particle_num[None]):
+            self.copy_particle(self.particles, p, self.particle_buffer, p)
+
+    # 判断当前子步是否需要重建液面
+    def need_rebuild_surface(self):
+        if self.substeps_since_surface is None or self.substeps_since_surface >= self.surface_interval:
+            return True
+        if self.surface_motion_threshold > 0:
+            self.compute_max_displacement()
+            return self.max_displacement[None] > self.surface_motion_threshold * self.surface_dx
+        return False
+
+    # 重建level set并计算网格上的表面张力
+    def rebuild_surface(self):
+        surface = self.fluid_surface_solver
+        with self.stage('create_level_set'):
+            changed = self.create_level_set()
+        # level set没有变化（且导出时没有更新过），网格上缓存的表面张力仍然有效
+        if not changed and not self.surface_tension_stale:
+            if self.surface_motion_threshold > 0:
+                self.store_surface_reference()
+            self.substeps_since_surface = 0
+            return
+        self.surface_tension_stale = False
+        if changed:
+            with self.stage('calculate_gradient'):
+                surface.calculate_gradient()
+            with self.stage('calculate_laplacian'):
+                surface.calculate_laplacian()
+        if self.tension_mode == self.tension_csf:
+            with self.stage('add_tension_csf'):
+                self.add_tension_csf()
+        else:
+            with self.stage('implicit_to_explicit'):
+                surface.init_surface_particles()
+                surface.implicit_to_explicit()
+            self.check_mesh_overflow()
+            with self.stage('discrete_triangles'):
+                surface.discrete_triangles()
+            with self.stage('add_tension'):
+                self.add_tension()
+            if self.profiler is not None:
+                self.profiler.count('triangles', surface.create_triangle_num[None])
+                self.profiler.count('surface_particle_num', surface.surface_particle_num[None])
+                self.profiler.count('sample_spacing_scale', surface.sample_spacing_scale[None])
+            # 放大采样间距只是降低表面粒子的分辨率（面积权重已经计入），丢弃粒子则会缺失部分液面的张力
+            dropped = surface.surface_particle_overflow[None]
+            if self.profiler is not None:
+                self.profiler.count('surface_particle_overflow', dropped)
+            if dropped:
+                warnings.warn('{} surface particles dropped beyond max_surface_particle_num={}'.format(
+                    dropped, surface.max_surface_particle_num))
+        if self.implicit_tension:
+            with self.stage('compute_tension_delta'):
+                self.compute_tension_delta()
+        if self.surface_band_particles:
+            with self.stage('classify_band_particles'):
+                self.classify_band_particles()
+            if self.profiler is not None:
+                self.profiler.count('band_particle_num', self.band_particle_num[None])
+        if self.surface_motion_threshold > 0:
+            self.store_surface_reference()
+        self.substeps_since_surface = 0
+
+    # Marching Cube的单元、三角形或顶点超出容量时网格被截断，表面张力和导出的网格都会缺失部分液面
+    def check_mesh_overflow(self):
+        surface = self.fluid_surface_solver
+        overflow = surface.mesh_overflow[None]
+        if self.profiler is not None:
+            self.profiler.count('mesh_overflow', overflow)
+        if overflow:
+            warnings.warn('marching cubes mesh truncated to {} triangles and {} vertices; increase the surface '
+                          'capacity or reduce surface_grid_num'.format(surface.max_triangle_num,
+                                                                       surface.max_vertex_num))
+
+    # 由粒子或网格质量构建level set，返回level set是否变化
+    def create_level_set(self):
+        if self.mass_surface:
+            return self.fluid_surface_solver.create_level_set_from_mass(self.node.node_m)
+        return self.fluid_surface_solver.create_level_set(self.particles.position, self.particles.material,
+                                                          self.create_particle_num)
+
+    # 开启profile时对阶段计时，否则不做任何事
+    def stage(self, name):
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.stage(name)
+
+    def substep(self):
+        if self.sort_interval > 0 and self.substep_index % self.sort_interval == 0:
+            with self.stage('sort_particles'):
+                self.sort_particles()
+                self.build_material_index()
+            # 排序后粒子编号改变，增量level set记录的粒子位置失效；运动检测的参考位置按粒子id存储，不受影响
+            if self.incremental_surface:
+                self.fluid_surface_solver.invalidate_level_set()
+            # 液面附近粒子列表按新的编号重新分类，level set本身不受排序影响
+            if self.surface_band_particles and self.substeps_since_surface is not None:
+                self.classify_band_particles()
+        self.substep_index += 1
+        if self.need_rebuild_surface():
+            self.rebuild_surface()
+        elif self.advect_tension:
+            with self.stage('advect_tension'):
+                self.advect_node_tension()
+        self.substeps_since_surface += 1
+        if self.implicit_tension:
+            with self.stage('reset_node'):
+                self.reset_node()
+            with self.stage('P2G'):
+                self.P2G()
+            with self.stage('grid_operator'):
+                self.grid_operator()
+            with self.stage('implicit_tension'):
+                self.solve_implicit_tension()
+            with self.stage('G2P'):
+                self.G2P()
+        elif self.fused_substep and self.profiler is None:
+            self.substep_kernel()
+        else:
+            if self.surface_band_particles:
+                with self.stage('gather_band_tension'):
+                    self.gather_band_tension()
+            with self.stage('reset_node'):
+                self.reset_node()
+            with self.stage('P2G'):
+                self.P2G()
+            with self.stage('grid_operator'):
+                self.grid_operator()
+            with self.stage('G2P'):
+                self.G2P()
+
     @ti.kernel
     def add_cube(self, position: ti.template(), length: float, particle_num: int, material: int):
-        rho = 1
+        rho = self.rho
         if material == self.material_solid:
-            rho = 1
+            rho = self.rho
         for i in range(self.create_particle_num[None], self.create_particle_num[None] + particle_num):
             n = ti.atomic_add(self.create_particle_num[None], 1)
             self.particles[n].position = ti.Vector([ti.random() for i in range(3)]) * ti.Vector(
@@ -201,24 +872,174 @@ class MPMSolver:
             self.particles[n].mass = self.p_vol * rho
             self.particles[n].Jp = 1
             self.particles[n].color = [1.0, 0.0, 0.0]
+            self.particles[n].id = n
 
     def run(self, frame, write_ply):
-        for s in range(32):
-            self.fluid_surface_solver.init_surface_particles()
-            self.fluid_surface_solver.create_level_set(self.particles.position, self.particles.material,
-                                                       self.create_particle_num[None])
-            self.fluid_surface_solver.calculate_gradient()
-            self.fluid_surface_solver.calculate_laplacian()
-            self.fluid_surface_solver.implicit_to_explicit()
-            self.fluid_surface_solver.discrete_triangles()
-            self.add_tension()
-            self.reset_node()
-            self.add_tension_to_particle()
-            self.P2G()
-            self.grid_operator()
-            self.G2P()
+        if self.profiler is not None:
+            self.profiler.begin_frame(frame)
+        # 新加入粒子后重建材料列表，并立即重建液面
+        particle_num = self.create_particle_num[None]
+        if particle_num != self.surface_built_particle_num:
+            self.build_material_index()
+            self.substeps_since_surface = None
+            self.surface_built_particle_num = particle_num
+            if self.incremental_surface:
+                self.fluid_surface_solver.invalidate_level_set()
+            # 网格上的质量还是上一次P2G（或初始的全零）的结果，不包含新的粒子
+            if self.mass_surface:
+                with self.stage('scatter_mass'):
+                    self.scatter_mass()
+        self.dt_history = []
+        self.implicit_history = []
+        if self.adaptive_dt:
+            wave_dt = min(self.frame_dt, self.elastic_dt(), self.capillary_dt())
+            t = 0.0
+            while t < self.frame_dt * (1 - 1e-6):
+                dt = min(self.compute_adaptive_dt(wave_dt), self.frame_dt - t)
+                self.substep_dt[None] = dt
+                self.substep()
+                self.dt_history.append(dt)
+                t += dt
+        else:
+            self.substep_dt[None] = self.dt
+            for s in range(self.steps):
+                self.substep()
+                self.dt_history.append(self.dt)
         if write_ply:
-            pos = self.particles.position.to_numpy()
-            writer = ti.PLYWriter(num_vertices=len(pos))
-            writer.add_vertex_pos(pos[:, 0], pos[:, 1], pos[:, 2])
-            writer.export_frame(frame, 'D:\\homework' + '\\water.ply')
+            with self.stage('export_frame'):
+                self.export_frame(frame)
+        if self.export_surface:
+            with self.stage('export_surface_mesh'):
+                self.export_surface_mesh(frame)
+        if self.trajectory_dir is not None:
+            with self.stage('record_trajectory'):
+                self.record_trajectory(frame)
+        if self.profiler is not None:
+            self.compute_max_speed()
+            self.profiler.count('active_particles', self.create_particle_num[None])
+            self.profiler.count('max_velocity', self.max_speed[None])
+            self.profiler.count('substeps', len(self.dt_history))
+            if self.implicit_tension:
+                self.profiler.count('implicit_iterations', sum(n for n, _ in self.implicit_history))
+                self.profiler.count('implicit_max_residual', max(r for _, r in self.implicit_history))
+            self.stats = self.profiler.end_frame()
+
+    # 将粒子位置拷贝到导出缓冲区
+    @ti.kernel
+    def copy_positions(self, buffer: ti.types.ndarray()):
+        for p in range(self.create_particle_num[None]):
+            for d in ti.static(range(3)):
+                buffer[p, d] = self.particles[p].position[d]
+
+    def export_frame(self, frame):
+        if self.exporter is None:
+            self.exporter = FrameExporter(self.output_dir, self.max_particle_num, file_format=self.export_format)
+        index = self.exporter.acquire()
+        self.copy_positions(self.exporter.buffers[index])
+        self.exporter.submit(frame, index, self.create_particle_num[None])
+
+    # 按粒子编号拷贝位置和速度，粒子排序不影响存档中的顺序
+    @ti.kernel
+    def copy_trajectory(self, positions: ti.types.ndarray(), velocities: ti.types.ndarray()):
+        for p in range(self.create_particle_num[None]):
+            n = self.particles[p].id
+            for d in ti.static(range(3)):
+                positions[n, d] = self.particles[p].position[d]
+                velocities[n, d] = self.particles[p].velocity[d]
+
+    def record_trajectory(self, frame):
+        if self.trajectory_writer is None:
+            self.trajectory_writer = TrajectoryWriter(self.trajectory_dir, self.max_particle_num,
+                                                      chunk_frames=self.trajectory_chunk_frames)
+            self.trajectory_positions = np.zeros((self.max_particle_num, 3), dtype=np.float32)
+            self.trajectory_velocities = np.zeros((self.max_particle_num, 3), dtype=np.float32)
+        self.copy_trajectory(self.trajectory_positions, self.trajectory_velocities)
+        self.trajectory_writer.append(frame, self.create_particle_num[None], position=self.trajectory_positions,
+                                      velocity=self.trajectory_velocities)
+
+    # 导出液面网格。最后一个子步重建过Marching Cube网格时直接使用，否则按当前粒子位置重新提取，
+    # 缓存在网格上的表面张力不受影响
+    def export_surface_mesh(self, frame):
+        surface = self.fluid_surface_solver
+        if self.tension_mode == self.tension_csf or self.substeps_since_surface != 1:
+            if self.create_level_set():
+                surface.calculate_gradient()
+                # 增量模式下梯度和拉普拉斯只在本次更新的block内计算，需要保持同步
+                if self.incremental_surface:
+                    surface.calculate_laplacian()
+                    self.surface_tension_stale = True
+            surface.implicit_to_explicit()
+            self.check_mesh_overflow()
+        if self.mesh_exporter is None:
+            self.mesh_exporter = MeshExporter(self.output_dir, surface.max_vertex_num, surface.max_triangle_num,
+                                              file_format=self.surface_export_format, normals=self.surface_normals)
+        index = self.mesh_exporter.acquire()
+        buffer = self.mesh_exporter.buffers[index]
+        surface.copy_mesh(buffer['vertices'], buffer['normals'], buffer['indices'], int(self.surface_normals))
+        self.mesh_exporter.submit(frame, index, surface.create_vertex_num[None], surface.create_triangle_num[None])
+
+    # 检查点中保存的求解器参数，恢复时网格分辨率和粒子容量必须一致
+    checkpoint_structure_keys = ('max_particle_num', 'grid_num', 'surface_grid_num')
+    checkpoint_parameter_keys = ('dt', 'steps', 'tension_coefficient')
+
+    # 保存检查点：所有粒子属性、粒子数、帧号和求解器参数写入同一个npz文件
+    def save_checkpoint(self, path, frame, compress=False):
+        particle_num = self.create_particle_num[None]
+        parameters = {key: getattr(self, key) for key in self.checkpoint_structure_keys +
+                      self.checkpoint_parameter_keys}
+        arrays = {'particle_' + key: value[:particle_num] for key, value in self.particles.to_numpy().items()}
+        arrays['particle_num'] = np.array(particle_num)
+        arrays['frame'] = np.array(frame)
+        arrays['substep_index'] = np.array(self.substep_index)
+        arrays['parameters'] = np.array(json.dumps(parameters))
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # 先写临时文件再替换，写检查点时崩溃不会损坏上一个检查点
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            if compress:
+                np.savez_compressed(f, **arrays)
+            else:
+                np.savez(f, **arrays)
+        os.replace(temp_path, path)
+
+    # 恢复检查点，返回保存时的帧号。需要在init_surface之后、第一次run之前调用，
+    # 液面在下一次run开始时按恢复的粒子重建。dt、steps和表面张力系数以求解器当前的设置为准
+    # （构造参数或命令行可以在重启时修改它们），与检查点中的值不同时只给出警告
+    def load_checkpoint(self, path):
+        with np.load(path) as data:
+            parameters = json.loads(str(data['parameters']))
+            for key in self.checkpoint_structure_keys:
+                if parameters[key] != getattr(self, key):
+                    raise ValueError('checkpoint {} = {} does not match solver {} = {}'.format(
+                        key, parameters[key], key, getattr(self, key)))
+            changed = ['{} {} -> {}'.format(key, parameters[key], getattr(self, key))
+                       for key in self.checkpoint_parameter_keys if parameters[key] != getattr(self, key)]
+            if changed:
+                warnings.warn('resuming {} with parameters different from the checkpoint: {}'.format(
+                    path, ', '.join(changed)))
+            particle_num = int(data['particle_num'])
+            arrays = {}
+            for key, value in self.particles.to_numpy().items():
+                value[:particle_num] = data['particle_' + key]
+                arrays[key] = value
+            self.particles.from_numpy(arrays)
+            self.create_particle_num[None] = particle_num
+            self.substep_index = int(data['substep_index'])
+            frame = int(data['frame'])
+        self.substeps_since_surface = None
+        self.surface_built_particle_num = 0
+        return frame
+
+    # 等待后台写出全部完成
+    def close(self):
+        if self.exporter is not None:
+            self.exporter.close()
+            self.exporter = None
+        if self.mesh_exporter is not None:
+            self.mesh_exporter.close()
+            self.mesh_exporter = None
+        if self.trajectory_writer is not None:
+            self.trajectory_writer.close()
+            self.trajectory_writer = None
@@ -0,0 +1,68 @@
+import contextlib
+import json
+import time
+
+import taichi as ti
+
+
+# 按阶段计时和计数。每个阶段前后调用ti.sync，记录的是设备上的真实耗时；
+# 每帧汇总为一条统计记录，也可以导出为Chrome trace（chrome://tracing或Perfetto打开）
+class Profiler:
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.events = []
+        self.frames = []
+        self.frame = None
+        self.stage_times = {}
+        self.stage_calls = {}
+        self.counters = {}
+
+    def now(self):
+        return time.perf_counter() - self.start_time
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        ti.sync()
+        start = self.now()
+        try:
+            yield
+        finally:
+            ti.sync()
+            duration = self.now() - start
+            self.events.append({'name': name, 'ph': 'X', 'ts': start * 1e6, 'dur': duration * 1e6,
+                                'pid': 0, 'tid': 0, 'args': {'frame': self.frame}})
+            self.stage_times[name] = self.stage_times.get(name, 0.0) + duration
+            self.stage_calls[name] = self.stage_calls.get(name, 0) + 1
+
+    # 记录计数器，同一帧内多次记录时保留最后一次的值
+    def count(self, name, value):
+        self.counters[name] = value
+        self.events.append({'name': name, 'ph': 'C', 'ts': self.now() * 1e6, 'pid': 0,
+                            'args': {name: value}})
+
+    def begin_frame(self, frame):
+        self.frame = frame
+        self.frame_start = self.now()
+        self.stage_times = {}
+        self.stage_calls = {}
+        self.counters = {}
+
+    def end_frame(self):
+        record = {
+            'frame': self.frame,
+            'time': self.now() - self.frame_start,
+            'stages': self.stage_times,
+            'calls': self.stage_calls,
+            'counters': self.counters,
+        }
+        self.frames.append(record)
+        self.frame = None
+        return record
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.frames, f, indent=2)
+
+    def write_chrome_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
@@ -0,0 +1,38 @@
+import os
+import sys
+
+import pytest
+
+np = pytest.importorskip('numpy')
+ti = pytest.importorskip('taichi')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fluid_surface import FluidSurface  # noqa: E402
+
+
+# 窄带splat构建的level set在窄带内（暴力解小于far_distance）应当与暴力遍历所有粒子的结果一致
+def test_splat_level_set_matches_brute_force():
+    ti.init(arch=ti.cpu, random_seed=0)
+    grid_num, particle_num = 24, 300
+    surface = FluidSurface(grid_num=grid_num, particle_type=0, radius=0.8 / grid_num)
+    surface.init_field()
+    surface.numpy_to_field()
+    position = ti.Vector.field(3, ti.f32, shape=particle_num)
+    material = ti.field(ti.i32, shape=particle_num)
+    create_particle_num = ti.field(ti.i32, shape=())
+    rng = np.random.default_rng(0)
+    position.from_numpy((rng.random((particle_num, 3)) * 0.6 + 0.2).astype(np.float32))
+    material.from_numpy(rng.integers(0, 2, particle_num).astype(np.int32))
+    create_particle_num[None] = particle_num
+
+    surface.create_level_set(position, material, create_particle_num)
+    splat = surface.sign_distance_field.to_numpy()
+    surface.create_level_set_brute_force(position, material, create_particle_num)
+    reference = surface.sign_distance_field.to_numpy()
+
+    band = reference < surface.far_distance
+    assert band.any()
+    np.testing.assert_allclose(splat[band], reference[band], atol=1e-5)
+    # 窄带外的节点统一截断为far_distance
+    assert np.all(splat[~band] == pytest.approx(surface.far_distance))
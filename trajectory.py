@@ -0,0 +1,161 @@
+import json
+import os
+
+import numpy as np
+
+index_file = 'index.json'
+
+
+# 轨迹存档：每帧的粒子数组按帧追加到分块的.npy文件中，每个块保存chunk_frames帧，
+# index.json记录帧号、每帧粒子数和块文件，读取时用内存映射，不需要整体加载
+class TrajectoryWriter:
+    def __init__(self, directory, max_particle_num, chunk_frames=32, fields=('position', 'velocity')):
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+        self.index_path = os.path.join(self.directory, index_file)
+        if os.path.exists(self.index_path):
+            # 继续写已有的存档（例如从检查点重启）
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+            if self.index['max_particle_num'] != max_particle_num or self.index['fields'] != list(fields):
+                raise ValueError('trajectory archive in {} does not match the solver'.format(self.directory))
+        else:
+            self.index = {
+                'max_particle_num': max_particle_num,
+                'chunk_frames': chunk_frames,
+                'fields': list(fields),
+                'frames': [],
+                'counts': [],
+                'chunks': [],
+            }
+        self.chunk = None
+        self.chunk_id = -1
+
+    def chunk_path(self, field, chunk_id):
+        return os.path.join(self.directory, '{}_{:05d}.npy'.format(field, chunk_id))
+
+    def open_chunk(self, chunk_id):
+        if chunk_id == self.chunk_id:
+            return
+        self.close_chunk()
+        chunk_frames = self.index['chunk_frames']
+        self.chunk = {}
+        for field in self.index['fields']:
+            path = self.chunk_path(field, chunk_id)
+            if chunk_id < len(self.index['chunks']):
+                self.chunk[field] = np.load(path, mmap_mode='r+')
+            else:
+                self.chunk[field] = np.lib.format.open_memmap(
+                    path, mode='w+', dtype=np.float32, shape=(chunk_frames, self.index['max_particle_num'], 3))
+        if chunk_id == len(self.index['chunks']):
+            self.index['chunks'].append({field: os.path.basename(self.chunk_path(field, chunk_id))
+                                         for field in self.index['fields']})
+        self.chunk_id = chunk_id
+
+    def close_chunk(self):
+        if self.chunk is not None:
+            for array in self.chunk.values():
+                array.flush()
+        self.chunk = None
+        self.chunk_id = -1
+
+    # 追加一帧，arrays为字段名到(count, 3)数组的映射。帧号不大于已有的最后一帧时，
+    # 先丢弃该帧及之后的记录（重启后重新模拟的帧覆盖旧记录）
+    def append(self, frame, count, **arrays):
+        frames = self.index['frames']
+        if frames and frame <= frames[-1]:
+            keep = next(n for n, f in enumerate(frames + [frame]) if f >= frame)
+            del frames[keep:]
+            del self.index['counts'][keep:]
+            chunk_num = -(-keep // self.index['chunk_frames'])
+            del self.index['chunks'][chunk_num:]
+            self.close_chunk()
+        n = len(frames)
+        chunk_id, local = divmod(n, self.index['chunk_frames'])
+        self.open_chunk(chunk_id)
+        for field in self.index['fields']:
+            self.chunk[field][local, :count] = arrays[field][:count]
+            self.chunk[field][local, count:] = np.nan
+        frames.append(frame)
+        self.index['counts'].append(count)
+        self.write_index()
+
+    def write_index(self):
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(temp_path, self.index_path)
+
+    def close(self):
+        self.close_chunk()
+        self.write_index()
+
+
+# 单个字段的惰性访问：field[frame, ids]只读取涉及的块，frame为存档中的帧序号（整数、切片或数组）
+class TrajectoryField:
+    def __init__(self, reader, field):
+        self.reader = reader
+        self.field = field
+
+    def __len__(self):
+        return len(self.reader)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        frame_key, particle_key = key[0], key[1:]
+        chunk_frames = self.reader.index['chunk_frames']
+        if np.isscalar(frame_key):
+            n = int(frame_key)
+            if n < 0:
+                n += len(self)
+            if not 0 <= n < len(self):
+                raise IndexError('frame index {} out of range'.format(frame_key))
+            chunk_id, local = divmod(n, chunk_frames)
+            return self.reader.chunk(self.field, chunk_id)[(local,) + particle_key]
+        frames = np.arange(len(self))[frame_key]
+        result = []
+        for chunk_id in np.unique(frames // chunk_frames):
+            local = frames[frames // chunk_frames == chunk_id] - chunk_id * chunk_frames
+            array = self.reader.chunk(self.field, chunk_id)
+            result.append(np.stack([array[(l,) + particle_key] for l in local]))
+        return np.concatenate(result) if result else np.empty((0,), dtype=np.float32)
+
+
+class TrajectoryReader:
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(self.directory, index_file)) as f:
+            self.index = json.load(f)
+        self.frames = np.array(self.index['frames'], dtype=np.int64)
+        self.counts = np.array(self.index['counts'], dtype=np.int64)
+        self.chunks = {}
+
+    def __len__(self):
+        return len(self.frames)
+
+    def chunk(self, field, chunk_id):
+        if (field, chunk_id) not in self.chunks:
+            path = os.path.join(self.directory, self.index['chunks'][chunk_id][field])
+            self.chunks[field, chunk_id] = np.load(path, mmap_mode='r')
+        return self.chunks[field, chunk_id]
+
+    # 帧号到存档序号
+    def frame_index(self, frame):
+        n = np.searchsorted(self.frames, frame)
+        if n == len(self.frames) or self.frames[n] != frame:
+            raise KeyError('frame {} not in trajectory'.format(frame))
+        return int(n)
+
+    def __getitem__(self, field):
+        if field not in self.index['fields']:
+            raise KeyError(field)
+        return TrajectoryField(self, field)
+
+    @property
+    def positions(self):
+        return self['position']
+
+    @property
+    def velocities(self):
+        return self['velocity']